@@ -0,0 +1,513 @@
+import asyncio
+import contextlib
+import dataclasses
+import os
+import pickle
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta
+from aiogram.types import InlineKeyboardMarkup
+from Classes.CatalogModel import CatalogGroup, CatalogProducts
+from Classes.CatalogSnapshot import CatalogSnapshot
+from Classes.Logger import Logger, LogLevel
+from Classes.PGMgr import PGMgr
+from keyboards import get_dynamic_group_product_keyboard
+
+# Таблица экранирования спецсимволов MarkdownV2
+MARKDOWN_TRANSLATION_TABLE = str.maketrans({
+    '_': '\\_',
+    '*': '\\*',
+    '[': '\\[',
+    ']': '\\]',
+    '(': '\\(',
+    ')': '\\)',
+    '~': '\\~',
+    '`': '\\`',
+    '>': '\\>',
+    '#': '\\#',
+    '+': '\\+',
+    '-': '\\-',
+    '=': '\\=',
+    '|': '\\|',
+    '{': '\\{',
+    '}': '\\}',
+    '.': '\\.',
+    '!': '\\!'
+})
+
+SELECT_GROUP_TEXT = ('*Выберите интересующую группу товаров, используя кнопки, '
+                     'размещенные ⬇️под сообщением⬇️*')
+
+
+class CatalogMgr:
+    # Группы, которые не показываются в ассортименте вместе с подгруппами
+    except_groups = ['NoMark']
+    # Новый снимок отклоняется, если товаров в нем меньше этой доли от текущего
+    min_products_ratio = 0.5
+    # После стольких отклонений подряд уменьшение каталога считается настоящим
+    max_rejected_builds = 3
+    # Последний удачный снимок сохраняется на диск для быстрого старта
+    cache_folder = 'cache'
+    snapshot_file_name = 'catalog_snapshot.pickle'
+    snapshot_format = 1
+    # Полная пересборка выполняется не реже этого интервала (секунд), в остальное время - только изменения
+    full_refresh_interval = 3600
+    # Если изменилось больше этой доли групп, дешевле собрать каталог целиком
+    max_delta_groups_ratio = 0.3
+    # Перекрытие окна изменений на случай долгих транзакций синхронизации
+    changes_overlap = timedelta(minutes=15)
+    # Пересборка по уведомлению ждет паузу в уведомлениях (секунд), но не дольше max_delay
+    notify_debounce = 10
+    notify_max_delay = 60
+    # Интервал пересборки по таймеру на случай потерянных уведомлений (секунд)
+    fallback_refresh_interval = 900
+    # Пауза перед повторным обновлением с реплики, чтобы она успела догнать основную БД (секунд)
+    replica_catchup_delay = 5
+    # Ограничения страницы списка товаров: длина текста (лимит Telegram 4096) и число товаров
+    page_text_limit = 3500
+    page_products_limit = 30
+    # Разделитель uid группы и номера страницы в callback_data
+    page_separator = ':'
+
+    def __init__(self, db: PGMgr):
+        self.db = db
+        self.logger = Logger()
+        self.rejected_builds = 0
+        # Ключи изменений, уже примененных к снимку, в пределах окна перекрытия
+        self.applied_changes = set()
+        self.last_full_refresh = 0.0
+        # Пересборки по таймеру, уведомлению и при старте не должны идти одновременно
+        self.refresh_lock = asyncio.Lock()
+        # Отданные пользователям страницы и наибольший возраст снимка, из которого они отданы, за период статистики
+        self.pages_served = 0
+        self.max_served_age = 0.0
+        self.snapshot = CatalogSnapshot(version=0, built_at=datetime.now(), build_duration=0.0, groups_count=0,
+                                        products_count=0, remains_count=0,
+                                        pages=self.render_pages((), {}, CatalogProducts(()))[0])
+
+    async def refresh(self, full: bool = False) -> bool:
+        async with self.refresh_lock:
+            return await self.refresh_snapshot(full)
+
+    async def refresh_snapshot(self, full: bool) -> bool:
+        started = time.perf_counter()
+        current = self.snapshot
+        source, snapshot = None, None
+        affected, change_keys = None, set()
+        try:
+            watermark = await self.db.get_catalog_watermark()
+            affected, change_keys = await self.load_changes(current, watermark, full)
+            if affected is not None and not affected:
+                # С прошлой сборки в каталоге ничего не изменилось: снимок остается прежним, но проверен
+                # до нового watermark, иначе окно изменений росло бы до следующей полной пересборки
+                self.applied_changes = change_keys
+                self.snapshot = dataclasses.replace(current, watermark=watermark)
+                return True
+
+            if affected:
+                snapshot = await self.create_delta_snapshot(current, affected, started, watermark)
+
+            if snapshot is None:
+                source = await self.load_source()
+                snapshot = self.create_snapshot(current.version + 1, *source, started, watermark) if source else None
+        except Exception as error:
+            await self.logger.log(f'Ошибка сборки каталога: {error}', LogLevel.ERROR)
+            source, snapshot = None, None
+
+        if snapshot is None:
+            await self.logger.log(f'Не удалось собрать каталог, остается снимок {current.describe()}',
+                                  LogLevel.ERROR)
+            return False
+
+        if (snapshot.products_count < current.products_count * self.min_products_ratio
+                and self.rejected_builds < self.max_rejected_builds):
+            self.rejected_builds += 1
+            await self.logger.log(f'Снимок каталога подозрительно мал ({snapshot.describe()}), '
+                                  f'остается снимок {current.describe()}', LogLevel.WARNING)
+            return False
+
+        self.rejected_builds = 0
+        self.applied_changes = change_keys
+        self.snapshot = snapshot
+        if source:
+            self.last_full_refresh = time.monotonic()
+            await self.logger.log(f'Каталог обновлен: {snapshot.describe()}', LogLevel.INFO)
+            await self.save_snapshot(snapshot, *source)
+        else:
+            await self.logger.log(f'Каталог обновлен частично ({len(affected)} групп): {snapshot.describe()}',
+                                  LogLevel.INFO)
+        return True
+
+    async def watch_changes(self) -> None:
+        # Синхронизация публикует уведомление после записи этапа. Серия уведомлений от нескольких
+        # этапов подряд сводится к одной пересборке
+        changed = asyncio.Event()
+        listener = asyncio.create_task(self.db.listen(self.db.catalog_channel, lambda payload: changed.set()))
+        try:
+            while True:
+                await changed.wait()
+                first_notification = time.monotonic()
+                while time.monotonic() - first_notification < self.notify_max_delay:
+                    changed.clear()
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.notify_debounce)
+                    except asyncio.TimeoutError:
+                        break
+                changed.clear()
+                await self.refresh()
+                if self.db.has_replica():
+                    # Каталог читается с реплики, которая могла еще не получить изменения из уведомления.
+                    # Неполученные изменения не попадают в водяной знак снимка, их подбирает повторное обновление
+                    await asyncio.sleep(self.replica_catchup_delay)
+                    await self.refresh()
+        finally:
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+
+    async def load_changes(self, current: CatalogSnapshot, watermark: datetime | None,
+                           full: bool) -> tuple[set | None, set]:
+        # Возвращает uid групп, которые нужно пересобрать, или None, если нужна полная сборка.
+        # Окно перекрытия ловит строки, закоммиченные позже, чем было записано их updated_at
+        if watermark is None:
+            return None, set()
+
+        full = (full or current.watermark is None
+                or time.monotonic() - self.last_full_refresh > self.full_refresh_interval)
+        since = (watermark if full else current.watermark) - self.changes_overlap
+        changes = await self.db.get_catalog_changes(since, watermark)
+        if changes is None:
+            return None, set()
+
+        change_keys = {(kind, uid, updated_at) for kind, uid, group_uid, prev_group_uid, updated_at in changes}
+        if full:
+            return None, change_keys
+
+        affected = set()
+        for kind, uid, group_uid, prev_group_uid, updated_at in changes:
+            if (kind, uid, updated_at) in self.applied_changes:
+                continue
+            if kind == 'group':
+                # Структура дерева меняется редко, проще собрать каталог целиком
+                return None, change_keys
+            affected.update(group for group in (group_uid, prev_group_uid) if group in current.groups_meta)
+
+        if len(affected) > len(current.groups_meta) * self.max_delta_groups_ratio:
+            return None, change_keys
+        return affected, change_keys
+
+    async def load_source(self) -> tuple[list, list] | None:
+        # Весь каталог собирается за два запроса вместо обхода дерева группа за группой
+        groups = await self.db.get_groups_tree(self.except_groups)
+        if groups is None:
+            await self.logger.log('Нет данных о группах товаров!', LogLevel.WARNING)
+            return None
+
+        remains = await self.db.get_catalog_remains()
+        if remains is None:
+            await self.logger.log('Нет данных об остатках товаров!', LogLevel.WARNING)
+            return None
+
+        return groups, remains
+
+    def create_snapshot(self, version: int, groups: list, remains: list, started: float,
+                        watermark: datetime | None = None, built_at: datetime | None = None) -> CatalogSnapshot:
+        root_groups, groups_index, products = self.build_tree(groups, remains)
+        pages, page_starts = self.render_pages(root_groups, groups_index, products)
+
+        return CatalogSnapshot(
+            version=version,
+            built_at=built_at or datetime.now(),
+            build_duration=time.perf_counter() - started,
+            groups_count=len(groups),
+            products_count=len(products),
+            remains_count=len(remains),
+            root_groups=root_groups,
+            groups_index=groups_index,
+            groups_meta={str(uid): ('assortment' if level == 1 else str(parent_uid), name, level)
+                         for uid, parent_uid, name, level in groups},
+            products=products,
+            pages=pages,
+            page_starts=page_starts,
+            watermark=watermark
+        )
+
+    async def create_delta_snapshot(self, current: CatalogSnapshot, affected: set, started: float,
+                                    watermark: datetime) -> CatalogSnapshot | None:
+        remains = await self.db.get_catalog_remains(list(affected))
+        if remains is None:
+            return None
+
+        # Таблица товаров копируется и дополняется строками пересобранных групп,
+        # старые строки этих групп остаются мусором до следующей полной сборки
+        products = current.products.copy()
+        store_ids = {name: store_id for store_id, name in enumerate(products.stores)}
+        new_products = {uid: array('i') for uid in affected}
+        product_rows = {}
+        remains_count = current.remains_count
+        for uid in affected:
+            group = current.groups_index.get(uid)
+            if group:
+                remains_count -= sum(1 for row in group.products for _ in current.products.iter_stock(row))
+
+        for group_uid, product_uid, product_name, store_name, count in remains:
+            store_id = store_ids.get(str(store_name))
+            if store_id is None:
+                # Появился новый магазин - столбцы остатков нужно строить заново
+                return None
+            row = product_rows.get(product_uid)
+            if row is None:
+                row = product_rows[product_uid] = products.add(product_name)
+                new_products[str(group_uid)].append(row)
+            products.set_stock(row, store_id, int(count))
+            remains_count += 1
+
+        # Пересобираются затронутые группы и их предки, остальные узлы переиспользуются из текущего снимка
+        groups_meta = current.groups_meta
+        dirty = set()
+        for uid in affected:
+            while uid in groups_meta and uid not in dirty:
+                dirty.add(uid)
+                uid = groups_meta[uid][0]
+
+        groups_index = dict(current.groups_index)
+        updates = {}
+        for uid in sorted(dirty, key=lambda group_uid: groups_meta[group_uid][2], reverse=True):
+            parent_uid, name, level = groups_meta[uid]
+            old_node = current.groups_index.get(uid)
+            children = {group.uid: group for group in old_node.sub_groups} if old_node else {}
+            self.apply_updates(children, updates.pop(uid, {}))
+
+            node = CatalogGroup(uid, level, parent_uid, name)
+            node.products = new_products[uid] if uid in affected else (old_node.products if old_node else array('i'))
+            node.sub_groups = tuple(sorted(children.values(), key=lambda group: group.group_name))
+            if not node.products and not node.sub_groups:
+                node = None
+                groups_index.pop(uid, None)
+            else:
+                groups_index[uid] = node
+            updates.setdefault(parent_uid, {})[uid] = node
+
+        # Лениво отрисованные дальние страницы принадлежат версии снимка и не переносятся
+        pages = {key: page for key, page in current.pages.items() if self.page_separator not in key}
+        page_starts = dict(current.page_starts)
+        root_groups = current.root_groups
+        if 'assortment' in updates:
+            roots = {group.uid: group for group in root_groups}
+            self.apply_updates(roots, updates['assortment'])
+            root_groups = tuple(sorted(roots.values(), key=lambda group: group.group_name))
+            pages['assortment'] = self.render_page(root_groups)
+
+        for uid in dirty:
+            page_starts.pop(uid, None)
+            pages.pop(uid, None)
+            group = groups_index.get(uid)
+            if group:
+                starts = self.split_pages(group, products)
+                if len(starts) > 1:
+                    page_starts[uid] = starts
+                pages[uid] = self.render_page(group.sub_groups, group, products, starts)
+
+        return CatalogSnapshot(
+            version=current.version + 1,
+            built_at=datetime.now(),
+            build_duration=time.perf_counter() - started,
+            groups_count=current.groups_count,
+            products_count=sum(len(group.products) for group in groups_index.values()),
+            remains_count=remains_count,
+            root_groups=root_groups,
+            groups_index=groups_index,
+            groups_meta=groups_meta,
+            products=products,
+            pages=pages,
+            page_starts=page_starts,
+            watermark=watermark
+        )
+
+    @staticmethod
+    def apply_updates(children: dict, updates: dict) -> None:
+        for uid, node in updates.items():
+            if node is None:
+                children.pop(uid, None)
+            else:
+                children[uid] = node
+
+    async def save_snapshot(self, snapshot: CatalogSnapshot, groups: list, remains: list) -> None:
+        # На диск пишутся исходные строки запросов: они компактнее готового дерева
+        # и не зависят от внутреннего устройства снимка
+        data = {
+            'format': self.snapshot_format,
+            'version': snapshot.version,
+            'built_at': snapshot.built_at,
+            'groups': [tuple(row) for row in groups],
+            'remains': [tuple(row) for row in remains]
+        }
+        try:
+            await asyncio.to_thread(self.write_snapshot_file, data)
+        except Exception as error:
+            await self.logger.log(f'Ошибка сохранения снимка каталога на диск: {error}', LogLevel.ERROR)
+
+    async def load_snapshot(self) -> bool:
+        started = time.perf_counter()
+        try:
+            data = await asyncio.to_thread(self.read_snapshot_file)
+            if not data or data.get('format') != self.snapshot_format:
+                return False
+            snapshot = self.create_snapshot(data['version'], data['groups'], data['remains'], started,
+                                            built_at=data['built_at'])
+        except Exception as error:
+            await self.logger.log(f'Ошибка загрузки снимка каталога с диска: {error}', LogLevel.ERROR)
+            return False
+
+        self.snapshot = snapshot
+        await self.logger.log(f'Каталог загружен с диска: {snapshot.describe()}', LogLevel.INFO)
+        return True
+
+    def write_snapshot_file(self, data: dict) -> None:
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(self.cache_folder)
+
+        # Запись во временный файл и атомарная подмена, чтобы при падении не остался обрезанный снимок
+        path = os.path.join(self.cache_folder, self.snapshot_file_name)
+        with open(f'{path}.tmp', 'wb') as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+
+    def read_snapshot_file(self) -> dict | None:
+        path = os.path.join(self.cache_folder, self.snapshot_file_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    @staticmethod
+    def build_tree(groups: list, remains: list) -> tuple[tuple, dict, CatalogProducts]:
+        # Названия магазинов хранятся один раз на снимок, остатки лежат в столбцах по номеру магазина
+        stores = tuple(sorted({sys.intern(str(row[3])) for row in remains}))
+        store_ids = {name: store_id for store_id, name in enumerate(stores)}
+        products = CatalogProducts(stores)
+
+        nodes = {}
+        for uid, parent_uid, name, level in groups:
+            uid = str(uid)
+            nodes[uid] = CatalogGroup(uid, level, 'assortment' if level == 1 else str(parent_uid), name)
+
+        product_rows = {}
+        for group_uid, product_uid, product_name, store_name, count in remains:
+            node = nodes.get(str(group_uid))
+            if node is None:
+                continue
+            row = product_rows.get(product_uid)
+            if row is None:
+                row = product_rows[product_uid] = products.add(product_name)
+                node.products.append(row)
+            products.set_stock(row, store_ids[str(store_name)], int(count))
+
+        # Группы приходят от листьев к корню, поэтому к моменту обработки группы
+        # все её непустые подгруппы уже прикреплены
+        root_groups = []
+        groups_index = {}
+        for uid, parent_uid, name, level in groups:
+            node = nodes[str(uid)]
+            if not node.products and not node.sub_groups:
+                continue
+
+            node.sub_groups = tuple(sorted(node.sub_groups, key=lambda group: group.group_name))
+            siblings = root_groups if level == 1 else nodes[node.parent_uid].sub_groups
+            siblings.append(node)
+            groups_index[node.uid] = node
+
+        # Сортировка групп по 'group_name'
+        return tuple(sorted(root_groups, key=lambda group: group.group_name)), groups_index, products
+
+    def record_page_served(self, snapshot: CatalogSnapshot) -> None:
+        self.pages_served += 1
+        self.max_served_age = max(self.max_served_age, (datetime.now() - snapshot.built_at).total_seconds())
+
+    async def log_freshness(self, reset: bool = False) -> None:
+        # Версия и возраст текущего снимка и насколько старые данные видели пользователи за период
+        snapshot = self.snapshot
+        age = (datetime.now() - snapshot.built_at).total_seconds()
+        watermark = f'{snapshot.watermark:%Y-%m-%d %H:%M:%S}' if snapshot.watermark else 'нет'
+        await self.logger.log(f'Каталог: снимок v{snapshot.version}, возраст {age:.0f} с, изменения по {watermark}; '
+                              f'отдано страниц {self.pages_served}, '
+                              f'наибольший возраст снимка при отдаче {self.max_served_age:.0f} с', LogLevel.INFO)
+        if reset:
+            self.pages_served = 0
+            self.max_served_age = 0.0
+
+    def get_page(self, snapshot: CatalogSnapshot, query: str) -> tuple[str, InlineKeyboardMarkup] | None:
+        page = snapshot.get_page(query)
+        if page or self.page_separator not in query:
+            return page
+
+        # Страницы после первой рендерятся при первом запросе и кэшируются в снимке
+        uid, _, page_number = query.partition(self.page_separator)
+        group = snapshot.get_group(uid)
+        starts = snapshot.page_starts.get(uid)
+        if not group or not starts or not page_number.isdigit() or not 0 < int(page_number) < len(starts):
+            return None
+
+        page = self.render_page(group.sub_groups, group, snapshot.products, starts, int(page_number))
+        snapshot.pages[query] = page
+        return page
+
+    @classmethod
+    def render_pages(cls, root_groups: tuple, groups_index: dict, products: CatalogProducts) -> tuple[dict, dict]:
+        # При сборке рендерятся первые страницы всех групп, дальние страницы больших групп - по запросу
+        pages = {'assortment': cls.render_page(root_groups)}
+        page_starts = {}
+        for uid, group in groups_index.items():
+            starts = cls.split_pages(group, products)
+            if len(starts) > 1:
+                page_starts[uid] = starts
+            pages[uid] = cls.render_page(group.sub_groups, group, products, starts)
+        return pages, page_starts
+
+    @classmethod
+    def split_pages(cls, group: CatalogGroup, products: CatalogProducts) -> tuple:
+        # Индексы первых товаров страниц. Длина считается по тексту без экранирования:
+        # лимит Telegram применяется к тексту уже после разбора разметки
+        starts = [0]
+        page_length = 0
+        for index, row in enumerate(group.products):
+            length = len(products.names[row]) + 4 + sum(len(store) + len(str(count)) + 5
+                                                          for store, count in products.iter_stock(row))
+            if page_length and (page_length + length > cls.page_text_limit
+                                or index - starts[-1] >= cls.page_products_limit):
+                starts.append(index)
+                page_length = 0
+            page_length += length
+        return tuple(starts)
+
+    @classmethod
+    def render_page(cls, sub_groups: tuple, group: CatalogGroup | None = None, products: CatalogProducts | None = None,
+                    starts: tuple = (0,), page: int = 0) -> tuple[str, InlineKeyboardMarkup]:
+        data_keyboard = [{'group_name': sub_group.group_name, 'group_uid': sub_group.uid} for sub_group in sub_groups]
+        parent_group = group.parent_uid if group else None
+
+        text_msg = SELECT_GROUP_TEXT
+        if group and group.products:
+            end = starts[page + 1] if page + 1 < len(starts) else len(group.products)
+            text_msg = '\n'.join(
+                '*' + str(products.names[row]).translate(MARKDOWN_TRANSLATION_TABLE) + ':*\n' +
+                '\n'.join(str('🏪' + store + ': ' + str(count)).translate(MARKDOWN_TRANSLATION_TABLE)
+                          for store, count in products.iter_stock(row)) + '\n'
+                for row in group.products[starts[page]:end]
+            )
+            if len(starts) > 1:
+                text_msg += f'\n_Страница {page + 1} из {len(starts)}_'
+
+        pages_row = []
+        if len(starts) > 1:
+            if page > 0:
+                pages_row.append({'text': '◀️', 'callback_data': cls.page_query(group.uid, page - 1)})
+            if page + 1 < len(starts):
+                pages_row.append({'text': '▶️', 'callback_data': cls.page_query(group.uid, page + 1)})
+
+        return text_msg, get_dynamic_group_product_keyboard(data_keyboard, parent_group, pages_row)
+
+    @classmethod
+    def page_query(cls, uid: str, page: int) -> str:
+        # Первая страница группы открывается по её uid, как и раньше
+        return uid if page == 0 else f'{uid}{cls.page_separator}{page}'
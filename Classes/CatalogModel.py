@@ -0,0 +1,54 @@
+from array import array
+
+
+# Компактное представление каталога. Вместо словарей на каждую группу и товар
+# группы хранятся в классах со __slots__, а товары - одной таблицей по столбцам:
+# список названий и по одному массиву остатков на магазин, индекс в массивах - номер товара
+class CatalogGroup:
+    __slots__ = ('uid', 'level', 'parent_uid', 'group_name', 'products', 'sub_groups')
+
+    def __init__(self, uid: str, level: int, parent_uid: str, group_name: str):
+        self.uid = uid
+        self.level = level
+        self.parent_uid = parent_uid
+        self.group_name = group_name
+        # Номера товаров группы в CatalogProducts
+        self.products = array('i')
+        # При сборке это список, после сборки - кортеж
+        self.sub_groups: list | tuple = []
+
+
+class CatalogProducts:
+    __slots__ = ('stores', 'names', 'columns')
+
+    # Значение остатка для магазина, в котором товара нет
+    NO_STOCK = -1
+
+    def __init__(self, stores: tuple):
+        # Названия магазинов хранятся один раз, номер магазина - индекс столбца остатков
+        self.stores = stores
+        self.names = []
+        self.columns = tuple(array('i') for _ in stores)
+
+    def __len__(self):
+        return len(self.names)
+
+    def copy(self) -> 'CatalogProducts':
+        products = CatalogProducts(self.stores)
+        products.names = self.names.copy()
+        products.columns = tuple(column[:] for column in self.columns)
+        return products
+
+    def add(self, name: str) -> int:
+        self.names.append(name)
+        for column in self.columns:
+            column.append(self.NO_STOCK)
+        return len(self.names) - 1
+
+    def set_stock(self, row: int, store_id: int, count: int) -> None:
+        self.columns[store_id][row] = count
+
+    def iter_stock(self, row: int):
+        for store, column in zip(self.stores, self.columns):
+            if column[row] != self.NO_STOCK:
+                yield store, column[row]
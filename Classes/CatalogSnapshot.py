@@ -0,0 +1,43 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from aiogram.types import InlineKeyboardMarkup
+from Classes.CatalogModel import CatalogGroup, CatalogProducts
+
+
+# Неизменяемый снимок каталога. Собирается целиком в фоне и подменяется одной
+# операцией присваивания, поэтому обработчики всегда видят согласованные данные
+@dataclass(frozen=True, slots=True)
+class CatalogSnapshot:
+    version: int
+    built_at: datetime
+    # Длительность сборки в секундах
+    build_duration: float
+    # Количество строк, полученных из БД
+    groups_count: int
+    products_count: int
+    remains_count: int
+    # Группы верхнего уровня, отсортированные по названию
+    root_groups: tuple = ()
+    # Плоский индекс uid группы -> узел дерева, ссылка на родителя хранится в самом узле
+    groups_index: dict = field(default_factory=dict)
+    # Все группы дерева, включая скрытые пустые: uid -> (uid родителя, название, уровень)
+    groups_meta: dict = field(default_factory=dict)
+    # Таблица товаров с остатками по магазинам
+    products: CatalogProducts = field(default_factory=lambda: CatalogProducts(()))
+    # Готовые к отправке тексты и клавиатуры: uid группы (или 'assortment') -> (текст, клавиатура).
+    # Дальние страницы больших групп дорисовываются сюда лениво под ключом 'uid:номер'
+    pages: dict = field(default_factory=dict)
+    # Индексы первых товаров страниц для групп, не помещающихся в одно сообщение
+    page_starts: dict = field(default_factory=dict)
+    # Время БД, до которого изменения каталога учтены в снимке
+    watermark: datetime | None = None
+
+    def get_group(self, uid: str) -> CatalogGroup | None:
+        return self.groups_index.get(uid)
+
+    def get_page(self, uid: str) -> tuple[str, InlineKeyboardMarkup] | None:
+        return self.pages.get(uid)
+
+    def describe(self) -> str:
+        return (f'v{self.version} от {self.built_at:%Y-%m-%d %H:%M:%S}, сборка {self.build_duration:.3f} с, '
+                f'групп {self.groups_count}, товаров {self.products_count}, остатков {self.remains_count}')
@@ -38,6 +38,10 @@ class Logger:
         return f"{timestamp} - {level.name} - {caller_info_str} - {message}"
 
     async def log(self, message, level=LogLevel.INFO):
+        # Отброшенные по уровню сообщения не должны стоить разбора стека
+        if level < self.log_level:
+            return
+
         current_date = datetime.now().strftime('%Y-%m-%d')
         if current_date != self.current_date:
             # Если сменилась дата, создаем новый файл лога и обновляем обработчик файлового журнала
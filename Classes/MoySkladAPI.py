@@ -1,13 +1,20 @@
 import datetime
+from collections import deque
+from functools import partial
+from itertools import islice
 
 import aiohttp
 import asyncio
+import config
 from config import TOKEN_MS
+from Classes.MoySkladClient import MoySkladClient, MoySkladError
 from Classes.PGMgr import PGMgr
 from Classes.Logger import Logger, LogLevel
 
 
 class MoyskladAPI:
+    # Этапы, после которых пересобирается catalog_stock: он содержит названия товаров, магазинов и остатки
+    CATALOG_STOCK_STAGES = ('stores', 'products', 'stock')
     BASE_URL = 'https://api.moysklad.ru/api/remap/1.2/entity/'
     REPORT_URL = 'https://api.moysklad.ru/api/remap/1.2/report/'
     COUNTERPARTY_URL = f'{BASE_URL}counterparty'
@@ -16,23 +23,42 @@ class MoyskladAPI:
     PRODUCT_FOLDER_URL = f'{BASE_URL}productfolder'
     PRODUCTS_URL = f'{BASE_URL}product'
     STOCK_BY_STORE_URL = f'{REPORT_URL}stock/bystore'
+    STOCK_CURRENT_URL = f'{REPORT_URL}stock/bystore/current'
     BONUS_OPERATIONS_URL = f'{BASE_URL}bonustransaction'
 
     LIMIT = 1000
+    EXPAND_LIMIT = 100
+    # Отчет текущих остатков отдает изменения не старше суток, при большем разрыве выполняется полная сверка
+    STOCK_CHANGES_MAX_AGE = datetime.timedelta(hours=24)
 
     def __init__(self):
         self.logger = Logger()
         self.token = TOKEN_MS
-        self.session = None
+        # Общий для всех этапов клиент: лимит запросов МойСклад считается на пользователя
+        self.client = MoySkladClient(self.token,
+                                     rate=getattr(config, 'MS_RATE_LIMIT', 45),
+                                     period=getattr(config, 'MS_RATE_PERIOD', 3.0),
+                                     max_parallel=getattr(config, 'MS_MAX_PARALLEL', 5),
+                                     max_retries=getattr(config, 'MS_MAX_RETRIES', 5))
         self.db = PGMgr()
+        # Сколько страниц выборки загружается параллельно, пока обрабатываются предыдущие
+        self.page_concurrency = max(1, getattr(config, 'MS_PAGE_CONCURRENCY', 4))
+        # Этапы запрашивают только изменения с прошлой синхронизации, полная сверка - раз в интервал (секунды)
+        self.full_sync_interval = getattr(config, 'MS_FULL_SYNC_INTERVAL', 86400)
+        # Изменения запрашиваются с запасом на расхождение часов и поздно зафиксированные документы
+        self.sync_overlap = datetime.timedelta(seconds=getattr(config, 'MS_SYNC_OVERLAP', 60))
+        # Фильтры по времени МойСклад принимает в часовом поясе аккаунта
+        self.ms_utc_offset = datetime.timedelta(hours=getattr(config, 'MS_UTC_OFFSET', 3))
 
     async def __aenter__(self):
         try:
             await self.initialize_session()
-            await self.db.connect_to_db()
+            if not await self.db.connect_to_db():
+                raise RuntimeError('не удалось подключиться к базе данных')
             return self
         except Exception as e:
             await self.logger.log(f"Error during initialization: {e}", LogLevel.ERROR)
+            await self.close_session()
             raise
 
     async def __aexit__(self, exc_type, exc_value, traceback):
@@ -44,31 +70,130 @@ class MoyskladAPI:
 
     async def initialize_session(self):
         try:
-            timeout = aiohttp.ClientTimeout(total=10, connect=5, sock_connect=5, sock_read=5)
-            self.session = aiohttp.ClientSession(headers={'Authorization': f'Bearer {self.token}'})
+            await self.client.open()
         except aiohttp.ClientError as ce:
             await self.logger.log(f"Aiohttp ClientError during session initialization: {ce}", LogLevel.ERROR)
             raise
 
     async def close_session(self):
         try:
-            if self.session:
-                await self.session.close()
+            await self.client.close()
         except aiohttp.ClientError as ce:
             await self.logger.log(f"Aiohttp ClientError during session closing: {ce}", LogLevel.ERROR)
             raise
 
-    async def fetch_data(self, url: str, params: dict = None):
+    async def fetch_data(self, url: str, params: dict = None) -> dict:
+        # Повторы и паузы при ограничениях выполняет клиент. Если ответ так и не получен, бросается
+        # MoySkladError: пропущенная страница оставила бы этап записанным наполовину, поэтому этап прерывается
         try:
-            async with self.session.get(url, params=params, ssl=False) as response:
-                response.raise_for_status()
-                return await response.json()
-        except aiohttp.ClientError as ce:
-            await self.logger.log(f"Aiohttp ClientError: {ce}", LogLevel.ERROR)
-        except asyncio.TimeoutError:
-            await self.logger.log("Request timed out", LogLevel.ERROR)
-        except Exception as e:
-            await self.logger.log(f"Error fetching data: {e}", LogLevel.ERROR)
+            return await self.client.get(url, params)
+        except MoySkladError as error:
+            await self.logger.log(f"Error fetching data: {error}", LogLevel.ERROR)
+            raise
+
+    async def process_pages(self, url: str, params: dict, process) -> int:
+        # Обходит все страницы выборки и передает каждую в process, возвращает сумму его результатов.
+        # Первая страница сообщает размер выборки (meta.size), остальные запрашиваются по offset
+        # параллельно, не больше page_concurrency сразу. process вызывается строго по порядку страниц
+        # в этой корутине, поэтому запись в БД идет последовательно и перекрывается загрузкой следующих страниц
+        response = await self.fetch_data(url, params)
+        changed = await process(response) or 0
+        meta = response.get('meta', {})
+        size = meta.get('size')
+        if size is None:
+            # Без размера выборки остается последовательный обход по nextHref
+            next_href = meta.get('nextHref')
+            while next_href:
+                response = await self.fetch_data(next_href)
+                changed += await process(response) or 0
+                next_href = response.get('meta', {}).get('nextHref')
+            return changed
+
+        step = meta.get('limit') or params.get('limit', self.LIMIT)
+        offsets = iter(range(meta.get('offset', 0) + step, size, step))
+        pending = deque()
+
+        def fetch_next(count: int) -> None:
+            for offset in islice(offsets, count):
+                pending.append(asyncio.create_task(self.fetch_data(url, {**params, 'offset': offset})))
+
+        fetch_next(self.page_concurrency)
+        try:
+            while pending:
+                response = await pending.popleft()
+                # Окно загрузки сдвигается до обработки страницы, чтобы сеть не простаивала во время записи
+                fetch_next(1)
+                changed += await process(response) or 0
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return changed
+
+    def get_ms_time(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + self.ms_utc_offset
+
+    async def get_sync_since(self, entity: str) -> datetime.datetime | None:
+        # Момент, с которого запрашиваются изменения этапа, или None, если нужна полная сверка
+        watermark = await self.db.get_sync_watermark(entity, self.full_sync_interval)
+        if not watermark or watermark[0] is None or watermark[1]:
+            await self.logger.log(f"Полная сверка этапа {entity}", LogLevel.INFO)
+            return None
+        return watermark[0] - self.sync_overlap
+
+    def add_updated_filter(self, params: dict, since: datetime.datetime | None) -> dict:
+        if since is None:
+            return params
+        condition = f'updated>={since:%Y-%m-%d %H:%M:%S}'
+        return {**params, 'filter': f"{params['filter']};{condition}" if params.get('filter') else condition}
+
+    def track_updated(self, process, sync: dict):
+        # Запоминает в sync['synced_to'] самое позднее время изменения среди полученных строк,
+        # с него начнется следующая синхронизация этапа. Время МойСклад в одном формате, поэтому строки сравнимы
+        async def process_tracked(data):
+            for item in data.get('rows', []):
+                updated = item.get('updated')
+                if updated and (sync['synced_to'] is None or updated > sync['synced_to']):
+                    sync['synced_to'] = updated
+            return await process(data)
+
+        return process_tracked
+
+    async def set_stage_watermark(self, entity: str, synced_to, since, transaction: dict) -> bool:
+        # Отметка этапа, примененного одной транзакцией. Если часть строк не записалась
+        # (например, товар ссылается на еще не загруженную группу), отметка не сдвигается,
+        # и следующий запуск запросит эти строки снова
+        if transaction['dropped']:
+            await self.logger.log(f"Этап {entity}: не записано строк {transaction['dropped']}, "
+                                  f"отметка синхронизации не сдвигается", LogLevel.WARNING)
+            return False
+        return await self.db.set_sync_watermark(entity, synced_to, since is None) is not None
+
+    async def fetch_all_pages(self, url: str, params: dict) -> list:
+        # Все страницы выборки в памяти: этап, который применяет их одной транзакцией, не держит
+        # соединение и блокировки строк, пока идут запросы к МойСклад с паузами и повторами
+        pages = []
+
+        async def collect(data):
+            pages.append(data)
+
+        await self.process_pages(url, params, collect)
+        return pages
+
+    async def apply_pages(self, pages: list, process) -> int:
+        changed = 0
+        for page in pages:
+            changed += await process(page) or 0
+        return changed
+
+    async def notify_catalog_changed(self, stage: str, changed: int) -> None:
+        # Бот пересобирает каталог по уведомлению, только если этап действительно изменил данные.
+        # Вызывается и после прерванного этапа, чтобы не потерять уже записанные изменения.
+        # Представление catalog_stock обновляется до уведомления, чтобы бот прочитал уже новые строки
+        if changed:
+            if stage in self.CATALOG_STOCK_STAGES:
+                await self.db.refresh_catalog_stock()
+            await self.db.notify(self.db.catalog_channel, stage)
 
     async def process_counterparties(self, data):
         for item in data.get('rows', []):
@@ -87,7 +212,8 @@ class MoyskladAPI:
             #     f"Sales Amount: {sales_amount}, Bonus Points: {bonus_amount}", LogLevel.INFO
             # )
 
-    async def process_stores(self, data):
+    async def process_stores(self, data) -> int:
+        rows = []
         for item in data.get('rows', []):
             name = item.get('name', '')
             uid = item.get('id', '')
@@ -95,9 +221,14 @@ class MoyskladAPI:
             if not name or not uid:
                 continue
 
-            await self.db.add_store(uid, name)
+            rows.append((uid, name))
+        if not rows:
+            return 0
+        changed = await self.db.add_stores(rows)
+        return changed or 0
 
     async def process_uoms(self, data):
+        rows = []
         for item in data.get('rows', []):
             name = item.get('name', '')
             description = item.get('description', '')
@@ -106,9 +237,12 @@ class MoyskladAPI:
             if not name or not uid:
                 continue
 
-            await self.db.add_uom(uid, name, description)
+            rows.append((uid, name, description))
+        if rows:
+            await self.db.add_uoms(rows)
 
-    async def process_product_folder(self, data):
+    async def process_product_folder(self, data) -> int:
+        rows = []
         for item in data.get('rows', []):
             name = item.get('name', '')
             uid = item.get('id', '')
@@ -120,9 +254,14 @@ class MoyskladAPI:
             if not name or not uid:
                 continue
 
-            await self.db.add_product_folder(uid, parent_uid, name)
+            rows.append((uid, parent_uid, name))
+        if not rows:
+            return 0
+        changed = await self.db.add_product_folders(rows)
+        return changed or 0
 
-    async def process_products(self, data):
+    async def process_products(self, data) -> int:
+        rows = []
         for item in data.get('rows', []):
             uid = item.get('id', '')
             name = item.get('name', '')
@@ -148,9 +287,16 @@ class MoyskladAPI:
             if not name or not uid or not group_uid:
                 continue
 
-            await self.db.add_product(uid, group_uid, uom_uid, name, buy_price, sales_price)
+            rows.append((uid, group_uid, uom_uid, name, buy_price, sales_price))
+        if not rows:
+            return 0
+        changed = await self.db.add_products(rows)
+        return changed or 0
 
-    async def process_stock_by_stores(self, data):
+    async def process_stock_by_stores(self, data, product_uids: set) -> int:
+        # В остатки каталога попадают только известные товары: строка с товаром, который синхронизация
+        # пропустила (например, без группы), сорвала бы пакетную запись всей страницы
+        rows = []
         for item in data.get('rows', []):
             product_href: str = item.get('meta', {}).get('href', '')
             product_uid = None
@@ -159,7 +305,7 @@ class MoyskladAPI:
             if product_href:
                 product_uid = product_href.split('?')[0].split('/')[-1]
 
-            if not product_uid or len(stock_by_store) < 1:
+            if product_uid not in product_uids or len(stock_by_store) < 1:
                 continue
 
             stocks = [{
@@ -174,134 +320,251 @@ class MoyskladAPI:
                 if not store_uid:
                     continue
 
-                await self.db.add_product_remains(product_uid, store_uid, stock)
+                rows.append((product_uid, store_uid, stock))
+        # Вся страница отчета (товары x склады) записывается одним запросом
+        if not rows:
+            return 0
+        changed = await self.db.add_products_remains(rows)
+        return changed or 0
+
+    async def process_stock_changes(self, data, product_uids: set) -> int:
+        # Отчет текущих остатков - плоский список строк товар x склад по всему ассортименту,
+        # в остатки каталога попадают только известные товары
+        rows = []
+        for item in data:
+            product_uid = item.get('assortmentId', '')
+            store_uid = item.get('storeId', '')
+
+            if product_uid not in product_uids or not store_uid:
+                continue
+
+            rows.append((product_uid, store_uid, item.get('stock', 0)))
+        if not rows:
+            return 0
+        changed = await self.db.add_products_remains(rows)
+        return changed or 0
+
+    async def process_bonus_operations(self, data, card_ids: dict, today: str) -> int:
+        rows = []
+        for item in data.get('rows', []):
+            # Если тип транзакции начисление и операция выполнена соберем по ней информацию
+            if item.get('transactionType', '') != 'EARNING' or item.get('transactionStatus', '') != 'COMPLETED':
+                continue
 
-    async def process_bonus_operations(self, operation_id, card_number, moment_operation, points_earned):
-        card = await self.db.get_card_by_number(card_number)
-        if card:
-            await self.db.add_bonus_operation(card[0], operation_id, moment_operation, points_earned)
-        else:
-            await self.logger.log(f"При добавлении бонусной операции не найдена карта - {card_number}",
-                                  LogLevel.WARNING)
+            points_earned = item.get('bonusValue', 0)
+            operation_id = item.get('id', '')
+            moment_operation = item.get('moment', today)
+            # Контрагент с номером карты приходит в самой операции (expand=agent)
+            card_number = item.get('agent', {}).get('discountCardNumber', None)
 
-    async def get_counterparties(self, tag: str):
+            if not operation_id or not card_number:
+                continue
+
+            card_id = card_ids.get(str(card_number))
+            if card_id is None:
+                await self.logger.log(f"При добавлении бонусной операции не найдена карта - {card_number}",
+                                      LogLevel.WARNING)
+                continue
+
+            rows.append((operation_id, card_id, points_earned, moment_operation))
+        if not rows:
+            return 0
+        added = await self.db.add_bonus_operations(rows)
+        return added or 0
+
+    async def get_counterparties(self, tag: str) -> bool:
         params = {'filter': f'tags={tag}', 'limit': self.LIMIT}
-        url = self.COUNTERPARTY_URL
+        failed_pages = 0
+
+        async def process_page(data):
+            nonlocal failed_pages
+            async with self.db.transaction() as transaction:
+                await self.process_counterparties(data)
+            if not transaction['committed']:
+                failed_pages += 1
 
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_counterparties(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            # Контрагенты всегда загружаются полностью: баланс бонусов меняется без изменения updated,
+            # а балансы карт должны обновляться каждый запуск этапа
+            await self.process_pages(self.COUNTERPARTY_URL, params, process_page)
+            return failed_pages == 0
 
         except Exception as e:
             await self.logger.log(f"Error processing counterparties: {e}", LogLevel.ERROR)
+            return False
 
-    async def get_stores(self):
+    async def get_stores(self) -> bool:
         params = {'limit': self.LIMIT}
-        url = self.STORES_URL
+        sync = {'synced_to': None}
 
+        changed = 0
+        committed = False
+        complete = False
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_stores(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            since = await self.get_sync_since('stores')
+            pages = await self.fetch_all_pages(self.STORES_URL, self.add_updated_filter(params, since))
+            async with self.db.transaction() as transaction:
+                changed = await self.apply_pages(pages, self.track_updated(self.process_stores, sync))
+                complete = await self.set_stage_watermark('stores', sync['synced_to'], since, transaction)
+            committed = transaction['committed']
+            if not committed:
+                changed = 0
 
         except Exception as e:
+            changed = 0
             await self.logger.log(f"Error processing stores: {e}", LogLevel.ERROR)
 
-    async def get_uoms(self):
+        await self.notify_catalog_changed('stores', changed)
+        return committed and complete
+
+    async def get_uoms(self) -> bool:
         params = {'limit': self.LIMIT}
-        url = self.UOMS_URL
+        sync = {'synced_to': None}
 
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_uoms(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            since = await self.get_sync_since('uoms')
+            pages = await self.fetch_all_pages(self.UOMS_URL, self.add_updated_filter(params, since))
+            async with self.db.transaction() as transaction:
+                await self.apply_pages(pages, self.track_updated(self.process_uoms, sync))
+                complete = await self.set_stage_watermark('uoms', sync['synced_to'], since, transaction)
+            return transaction['committed'] and complete
 
         except Exception as e:
             await self.logger.log(f"Error processing uoms: {e}", LogLevel.ERROR)
+            return False
 
-    async def get_groups_product(self):
+    async def get_groups_product(self) -> bool:
         params = {'limit': self.LIMIT}
-        url = self.PRODUCT_FOLDER_URL
+        sync = {'synced_to': None}
 
+        changed = 0
+        committed = False
+        complete = False
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_product_folder(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            since = await self.get_sync_since('groups')
+            pages = await self.fetch_all_pages(self.PRODUCT_FOLDER_URL, self.add_updated_filter(params, since))
+            async with self.db.transaction() as transaction:
+                changed = await self.apply_pages(pages, self.track_updated(self.process_product_folder, sync))
+                complete = await self.set_stage_watermark('groups', sync['synced_to'], since, transaction)
+            committed = transaction['committed']
+            if not committed:
+                changed = 0
 
         except Exception as e:
+            changed = 0
             await self.logger.log(f"Error processing product folder: {e}", LogLevel.ERROR)
 
-    async def get_products(self):
+        await self.notify_catalog_changed('groups', changed)
+        return committed and complete
+
+    async def get_products(self) -> bool:
         params = {'limit': self.LIMIT}
-        url = self.PRODUCTS_URL
+        sync = {'synced_to': None, 'failed': False}
+
+        changed = 0
+        success = False
+
+        async def process_page(data):
+            nonlocal changed
+            # Товаров много, поэтому каждая страница фиксируется своей транзакцией.
+            # Счетчик ведется здесь, чтобы уведомить бота и о страницах, записанных до ошибки
+            async with self.db.transaction() as transaction:
+                page_changed = await self.process_products(data)
+            if transaction['committed']:
+                changed += page_changed
+            # Строки, пропущенные из-за ошибки, тоже не дают сдвинуть отметку
+            if not transaction['committed'] or transaction['dropped']:
+                sync['failed'] = True
 
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_products(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            since = await self.get_sync_since('products')
+            await self.process_pages(self.PRODUCTS_URL, self.add_updated_filter(params, since),
+                                     self.track_updated(process_page, sync))
+            # Отметка сдвигается, только если записаны все строки всех страниц, иначе изменения запросятся повторно
+            if not sync['failed']:
+                success = await self.db.set_sync_watermark('products', sync['synced_to'], since is None) is not None
 
         except Exception as e:
             await self.logger.log(f"Error processing product: {e}", LogLevel.ERROR)
 
-    async def get_stock_by_stores(self):
+        await self.notify_catalog_changed('products', changed)
+        return success
+
+    async def get_stock_by_stores(self) -> bool:
         params = {'limit': self.LIMIT, 'filter': 'stockMode=all', 'groupBy': 'product'}
-        url = self.STOCK_BY_STORE_URL
 
+        changed = 0
+        committed = False
+        complete = False
         try:
-            while url:
-                response = await self.fetch_data(url, params)
-                await self.process_stock_by_stores(response)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            # Отметка остатков - время МойСклад на начало запроса, в строках отчета времени изменения нет
+            synced_to = self.get_ms_time()
+            since = await self.get_sync_since('stock')
+            if since is not None and synced_to - since > self.STOCK_CHANGES_MAX_AGE:
+                since = None
+            if since is None:
+                pages = await self.fetch_all_pages(self.STOCK_BY_STORE_URL, params)
+            else:
+                # Только остатки, изменившиеся с прошлой синхронизации, включая обнулившиеся
+                changes_params = {'changedSince': f'{since:%Y-%m-%d %H:%M:%S}', 'include': 'zeroLines',
+                                  'stockType': 'stock'}
+                stock_changes = await self.fetch_data(self.STOCK_CURRENT_URL, changes_params)
+            # Отчет об остатках применяется целиком одной транзакцией:
+            # бот не видит остатки, записанные наполовину
+            async with self.db.transaction() as transaction:
+                # Список товаров читается один раз на весь отчет
+                product_uids = await self.db.get_product_uids()
+                if product_uids is None:
+                    raise RuntimeError('не удалось получить список товаров')
+                if since is None:
+                    changed = await self.apply_pages(pages, partial(self.process_stock_by_stores,
+                                                                    product_uids=product_uids))
+                else:
+                    changed = await self.process_stock_changes(stock_changes, product_uids)
+                complete = await self.set_stage_watermark('stock', synced_to, since, transaction)
+            committed = transaction['committed']
+            if not committed:
+                changed = 0
 
         except Exception as e:
+            changed = 0
             await self.logger.log(f"Error processing stock by stores: {e}", LogLevel.ERROR)
 
-    async def get_bonus_operations(self):
+        await self.notify_catalog_changed('stock', changed)
+        return committed and complete
+
+    async def get_bonus_operations(self) -> bool:
         today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).strftime('%Y-%m-%d %H:%M:%S')
+        # expand раскрывает контрагента прямо в операции, но работает только при limit не больше 100
         params = {
             "filter": f"moment>={today}",
-            "limit": self.LIMIT
+            "expand": "agent",
+            "limit": self.EXPAND_LIMIT
         }
-        url = self.BONUS_OPERATIONS_URL
+
+        failed_pages = 0
+
+        async def process_page(data):
+            nonlocal failed_pages
+            async with self.db.transaction() as transaction:
+                added = await self.process_bonus_operations(data, card_ids, today)
+            if not transaction['committed']:
+                failed_pages += 1
+                return 0
+            return added
 
         try:
-            while url:
-                # Получаем операции с баллами
-                response = await self.fetch_data(url, params)
-                for item in response.get('rows', []):
-                    # Если тип транзакции начисление и операция выполнена соберем по ней информацию
-                    if item.get('transactionType', '') == 'EARNING' and item.get('transactionStatus',
-                                                                                 '') == 'COMPLETED':
-                        points_earned = item.get('bonusValue', 0)
-                        operation_id = item.get('id', '')
-                        moment_operation = item.get('moment', today)
-                        counterparty_id = item.get('agent', {}).get('meta', {}).get('href', '').split('/')[-1]
-
-                        if operation_id and counterparty_id:
-                            # Получим информацию по контрагенту и его карте
-                            counterparty_url = f'{self.COUNTERPARTY_URL}/{counterparty_id}'
-                            counterparty_response = await self.fetch_data(counterparty_url)
-                            card_number = counterparty_response.get('discountCardNumber', None)
-
-                            if card_number:
-                                await self.process_bonus_operations(operation_id, card_number, moment_operation,
-                                                                    points_earned)
-                url = response.get('meta', {}).get('nextHref')
-                params = {}
+            # Карты сопоставляются по номеру из словаря, загруженного один раз за этап
+            card_ids = await self.db.get_card_ids()
+            if card_ids is None:
+                return False
+            # Получаем операции с баллами
+            added = await self.process_pages(self.BONUS_OPERATIONS_URL, params, process_page)
+            await self.logger.log(f"Добавлено бонусных операций: {added}", LogLevel.DEBUG)
+            return failed_pages == 0
         except Exception as e:
             await self.logger.log(f"Error processing bonus operations: {e}", LogLevel.ERROR)
+            return False
 
 
 # Пример использования
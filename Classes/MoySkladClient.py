@@ -0,0 +1,136 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+from Classes.Logger import Logger, LogLevel
+
+
+class MoySkladError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+# HTTP клиент МойСклад с ограничением частоты запросов.
+# Лимиты API: не больше 45 запросов за 3 секунды и не больше 5 параллельных запросов от пользователя.
+# Частота держится корзиной токенов, параллельность - семафором. На 429 и 5xx запрос повторяется
+# с паузой из заголовков лимита или экспоненциальной паузой со случайным разбросом
+class MoySkladClient:
+    # Ответы, после которых запрос имеет смысл повторить
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, token: str, rate: int = 45, period: float = 3.0, max_parallel: int = 5,
+                 max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 30.0):
+        self.logger = Logger()
+        self.token = token
+        self.session = None
+        # Корзина токенов: capacity запросов сразу, дальше rate запросов за period секунд
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.tokens_updated_at = time.monotonic()
+        self.bucket_lock = asyncio.Lock()
+        self.parallel = asyncio.Semaphore(max_parallel)
+        # До этого момента все запросы ждут: сервер сообщил, что лимит исчерпан
+        self.paused_until = 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def open(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=60, connect=5, sock_connect=5, sock_read=30)
+        self.session = aiohttp.ClientSession(headers={'Authorization': f'Bearer {self.token}'}, timeout=timeout)
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def take_token(self) -> None:
+        # Ожидание идет под блокировкой, поэтому токены выдаются ожидающим по очереди
+        async with self.bucket_lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.tokens_updated_at) * self.fill_rate)
+                self.tokens_updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+    def pause(self, delay: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def get_retry_delay(self, attempt: int, headers=None) -> float:
+        # Заголовки МойСклад содержат миллисекунды, стандартный Retry-After - секунды
+        if headers:
+            retry_after = headers.get('X-Lognex-Retry-After') or headers.get('X-Lognex-Retry-TimeInterval')
+            if retry_after:
+                return float(retry_after) / 1000 + random.uniform(0, 0.1 * self.backoff_base)
+            retry_after = headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return float(retry_after) + random.uniform(0, 0.1 * self.backoff_base)
+        # Экспоненциальная пауза с полным случайным разбросом, чтобы повторы не шли одной волной
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def update_limits(self, headers) -> None:
+        # Если сервер сообщил, что запросы в окне кончились, ждем сброса окна, не дожидаясь 429
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-Lognex-Reset')
+        if remaining is not None and reset and remaining.isdigit() and int(remaining) == 0:
+            self.pause(float(reset) / 1000)
+
+    async def get(self, url: str, params: dict = None) -> dict:
+        # Возвращает JSON ответа или бросает MoySkladError, когда повторы исчерпаны
+        attempt = 0
+        while True:
+            await self.take_token()
+            status = None
+            headers = None
+            try:
+                async with self.parallel:
+                    self.requests += 1
+                    async with self.session.get(url, params=params, ssl=False) as response:
+                        status = response.status
+                        headers = response.headers
+                        self.update_limits(headers)
+                        if status < 400:
+                            return await response.json()
+                        error = f"HTTP {status}: {await response.text()}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as client_error:
+                error = f"{type(client_error).__name__}: {client_error}"
+
+            if status is not None and status not in self.retry_statuses:
+                self.failed += 1
+                raise MoySkladError(f"Запрос {url} отклонен - {error}", status)
+            if attempt >= self.max_retries:
+                self.failed += 1
+                raise MoySkladError(f"Запрос {url} не выполнен за {attempt + 1} попыток - {error}", status)
+
+            delay = self.get_retry_delay(attempt, headers)
+            if status == 429:
+                # Лимит общий для всех запросов клиента, поэтому на паузу встают все
+                self.throttled += 1
+                self.pause(delay)
+            self.retries += 1
+            attempt += 1
+            await self.logger.log(f"Повтор запроса {url} через {delay:.2f} с ({attempt}/{self.max_retries}) - "
+                                  f"{error[:200]}", LogLevel.WARNING)
+            await asyncio.sleep(delay)
+
+    def describe(self) -> str:
+        return (f'МойСклад: запросов {self.requests}, ограничено сервером (429) {self.throttled}, '
+                f'повторов {self.retries}, ошибок {self.failed}')
+
+    async def log_stats(self, reset: bool = False) -> None:
+        await self.logger.log(self.describe(), level=LogLevel.INFO)
+        if reset:
+            self.requests = self.throttled = self.retries = self.failed = 0
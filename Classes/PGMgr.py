@@ -1,10 +1,52 @@
+import asyncio
+import sys
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import aiopg
 import psycopg2
+import config
 from Classes.Logger import Logger, LogLevel
+from Classes.QueryStats import QueryStats
+from Classes.SchemaMgr import SchemaMgr
+from Classes.TTLCache import TTLCache
 from config import *
 
 
+# Пул соединений перегружен, запрос отброшен без ожидания соединения.
+# Методы PGMgr, которые вызываются из обработчиков бота, пробрасывают его до middleware бота,
+# а не превращают в пустой результат, как остальные ошибки запросов
+class PoolSaturated(Exception):
+    pass
+
+
 class PGMgr:
+    # Канал уведомлений об изменении данных каталога синхронизацией
+    catalog_channel = 'catalog_changed'
+    # Служебные методы, которые не считаются именем запроса в статистике
+    stats_skip_frames = {'execute_query', 'execute_command', 'upsert_chunk', 'upsert_rows', 'timed_execute'}
+    # Значение кэша карт для пользователя, у которого карты нет
+    no_card = object()
+    # Запросы горячего пути; SchemaMgr.check_query_plans проверяет их планы, поэтому текст запроса задается один раз
+    get_user_query = """SELECT * FROM users WHERE tg_id = %s"""
+    get_card_query = """SELECT * FROM cards WHERE user_id = %s"""
+    # Строки каталога, изменившиеся после since: (вид, uid, группа, прежняя группа, время изменения).
+    # Товары и остатки бот читает из catalog_stock, поэтому их изменения берутся только до until -
+    # времени последнего обновления представления
+    get_catalog_changes_query = """
+        SELECT 'group', uid::text, parent_uid::text, NULL, updated_at
+        FROM product_groups WHERE updated_at > %s
+        UNION ALL
+        SELECT 'product', uid::text, group_uid::text, prev_group_uid, updated_at
+        FROM products WHERE updated_at > %s AND (%s::timestamptz IS NULL OR updated_at <= %s)
+        UNION ALL
+        SELECT 'remains', pr.product_uid::text || '/' || pr.store_uid::text, p.group_uid::text, NULL, 
+               pr.updated_at
+        FROM product_remains pr
+        JOIN products p ON p.uid = pr.product_uid
+        WHERE pr.updated_at > %s AND (%s::timestamptz IS NULL OR pr.updated_at <= %s)
+    """
+
     def __init__(self):
         self.pg_con = None
         self.pg_user = PG_USER
@@ -14,16 +56,83 @@ class PGMgr:
         self.database = DATABASE
         self.database_test = DATABASE_TEST
         self.logger = Logger()
+        # Пауза перед повторной подпиской на уведомления после разрыва соединения
+        self.listen_retry_delay = 5
+        # Максимум строк в одном пакетном INSERT
+        self.batch_size = 1000
+        # Открытая транзакция текущей задачи: {'conn': соединение, 'failed': была ошибка, 'committed': итог,
+        # 'dropped': сколько строк upsert_rows пропустил из-за ошибки}
+        self.transaction_state = ContextVar('pg_transaction', default=None)
+        # Статистика времени запросов, порог медленного запроса в секундах (0 - не логировать)
+        self.query_stats = QueryStats(getattr(config, 'PG_SLOW_QUERY_THRESHOLD', 0.5))
+        # Пользователи по tg_id и карты по id пользователя читаются на каждое нажатие кнопки.
+        # Баланс карты обновляет синхронизация в другом процессе, кэш бота она сбросить не может:
+        # срок жизни записи - единственная граница устаревания баланса, поэтому у карт он короче
+        cache_size = getattr(config, 'PG_CACHE_SIZE', 10000)
+        self.users_cache = TTLCache('пользователей', cache_size, getattr(config, 'PG_USER_CACHE_TTL', 600))
+        self.cards_cache = TTLCache('карт', cache_size, getattr(config, 'PG_CARD_CACHE_TTL', 30))
+        # Заполняются при подключении: id роли USER для регистрации и столбцы users,
+        # по количеству которых строка users+cards делится на пользователя и карту
+        self.user_role_id = None
+        self.users_columns = []
+        # Размеры пула, ожидание свободного соединения и таймаут запроса на клиенте в секундах,
+        # statement_timeout на сервере в миллисекундах (0 - без ограничения)
+        self.pool_min_size = getattr(config, 'PG_POOL_MIN_SIZE', 1)
+        self.pool_max_size = getattr(config, 'PG_POOL_MAX_SIZE', 10)
+        self.acquire_timeout = getattr(config, 'PG_ACQUIRE_TIMEOUT', 5)
+        self.query_timeout = getattr(config, 'PG_QUERY_TIMEOUT', 60)
+        self.statement_timeout = getattr(config, 'PG_STATEMENT_TIMEOUT', 30000)
+        # Таймаут на клиенте в секундах для пересборки catalog_stock и миграций: на сервере они идут
+        # без statement_timeout, а таймаут пула (query_timeout) прервал бы их через минуту
+        self.maintenance_timeout = getattr(config, 'PG_MAINTENANCE_TIMEOUT', 3600)
+        # Сколько задач может ждать соединение, прежде чем запросы обработчиков бота начнут отбрасываться
+        self.max_pool_waiters = getattr(config, 'PG_MAX_POOL_WAITERS', 50)
+        # Включается обработчиками бота: при перегрузке их запросы отбрасываются с PoolSaturated,
+        # фоновые задачи в это время просто ждут соединение
+        self.shedding = ContextVar('pg_shedding', default=False)
+        self.pool_waiters = 0
+        self.pool_waiters_peak = 0
+        self.shed_requests = 0
+        # Реплика для чтения, без PG_READ_HOST чтение идет с основной БД
+        self.read_host = getattr(config, 'PG_READ_HOST', None)
+        self.read_port = getattr(config, 'PG_READ_PORT', self.pg_port)
+        self.pg_read_con = None
+        # Пользователи, которые недавно что-то записали, читают свои данные с основной БД,
+        # пока реплика не догонит: ключи ('tg', tg_id) и ('user', id пользователя)
+        self.recent_writes = TTLCache('недавних записей', cache_size,
+                                      getattr(config, 'PG_READ_YOUR_WRITES_WINDOW', 10))
+
+    async def create_pool(self, host, port):
+        dsn = f'dbname={self.database} user={self.pg_user} password={self.pg_pass} host={host} port={port}'
+        pool = await aiopg.create_pool(dsn, minsize=self.pool_min_size, maxsize=self.pool_max_size,
+                                       timeout=self.query_timeout,
+                                       options=f'-c statement_timeout={self.statement_timeout}')
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT version()')
+                version = await cur.fetchone()
+                await self.logger.log(f"Вы подключены к {host}:{port} - {version}", level=LogLevel.INFO)
+        return pool
 
     async def connect_to_db(self):
-        dsn = f'dbname={self.database} user={self.pg_user} password={self.pg_pass} host={self.pg_host}'
         try:
-            self.pg_con = await aiopg.create_pool(dsn)
-            async with self.pg_con.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute('SELECT version()')
-                    version = await cur.fetchone()
-                    await self.logger.log(f"Вы подключены к - {version}", level=LogLevel.INFO)
+            self.pg_con = await self.create_pool(self.pg_host, self.pg_port)
+            self.pg_read_con = self.pg_con
+            if self.read_host:
+                try:
+                    self.pg_read_con = await self.create_pool(self.read_host, self.read_port)
+                except (Exception, psycopg2.Error) as e:
+                    await self.logger.log(f"Реплика для чтения недоступна, чтение идет с основной БД: {e}",
+                                          level=LogLevel.ERROR)
+            # Без актуальной схемы не работают каталог и синхронизация - запуск прерывается.
+            # Миграции очистки дублей запуск не прерывают, они повторяются при следующем подключении
+            if not await SchemaMgr(self).migrate():
+                await self.logger.log("Схема базы данных не обновлена, подробности в логе миграций",
+                                      level=LogLevel.CRITICAL)
+                await self.close_db_connection()
+                return False
+            await self.load_users_schema()
+            await self.sync_catalog_stores()
             return True
         except (Exception, psycopg2.Error) as e:
             await self.logger.log(f"Ошибка при подключении к базе данных: {e}", level=LogLevel.ERROR)
@@ -31,6 +140,9 @@ class PGMgr:
 
     async def close_db_connection(self):
         try:
+            if self.pg_read_con and self.pg_read_con is not self.pg_con:
+                self.pg_read_con.close()
+                await self.pg_read_con.wait_closed()
             if hasattr(self, 'pg_con') and self.pg_con:
                 self.pg_con.close()
                 await self.pg_con.wait_closed()
@@ -39,230 +151,703 @@ class PGMgr:
             await self.logger.log(f"Ошибка при закрытии соединения с базой данных: {e}", level=LogLevel.ERROR)
             raise
 
-    async def execute_query(self, query, *args, fetch_all: bool = False):
+    @asynccontextmanager
+    async def acquire(self, replica: bool = False):
+        # Соединение из пула с ограниченным ожиданием и учетом ожидающих задач
+        pool = self.pg_read_con if replica else self.pg_con
+        shedding = self.shedding.get()
+        if shedding and self.pool_waiters >= self.max_pool_waiters:
+            self.shed_requests += 1
+            raise PoolSaturated(f'ожидают соединения {self.pool_waiters} задач')
+
+        started = time.perf_counter()
+        self.pool_waiters += 1
+        self.pool_waiters_peak = max(self.pool_waiters_peak, self.pool_waiters)
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            if not shedding:
+                raise
+            self.shed_requests += 1
+            raise PoolSaturated(f'нет свободного соединения за {self.acquire_timeout} с')
+        finally:
+            self.pool_waiters -= 1
+            self.query_stats.add_pool_wait(time.perf_counter() - started)
+
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    @asynccontextmanager
+    async def connection(self, replica: bool = False):
+        # Внутри transaction() запросы идут через соединение транзакции (всегда основная БД),
+        # иначе - через свободное соединение пула основной БД или реплики
+        transaction = self.transaction_state.get()
+        if transaction:
+            yield transaction['conn']
+        else:
+            async with self.acquire(replica) as conn:
+                yield conn
+
+    def has_replica(self) -> bool:
+        return self.pg_read_con is not None and self.pg_read_con is not self.pg_con
+
+    def read_from_replica(self, *keys) -> bool:
+        # Чтение с реплики, если по ключам пользователя не было записей в окне read-your-writes
+        return self.has_replica() and not any(key in self.recent_writes for key in keys)
+
+    def mark_written(self, *keys) -> None:
+        for key in keys:
+            self.recent_writes.put(key, True)
+
+    def describe_pool(self) -> str:
+        if not self.pg_con:
+            return 'Пул соединений не создан'
+        in_use = self.pg_con.size - self.pg_con.freesize
+        description = (f'Пул соединений: занято {in_use}/{self.pool_max_size}, свободно {self.pg_con.freesize}, '
+                       f'ожидают {self.pool_waiters} (пик {self.pool_waiters_peak}), '
+                       f'отброшено запросов {self.shed_requests}')
+        if self.has_replica():
+            in_use = self.pg_read_con.size - self.pg_read_con.freesize
+            description += f'\nПул реплики: занято {in_use}/{self.pool_max_size}, свободно {self.pg_read_con.freesize}'
+        return description
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Все запросы внутри блока выполняются на одном соединении и фиксируются одним COMMIT.
+        # При исключении или ошибке любого запроса транзакция откатывается, результат - в state['committed'].
+        # Вложенный блок присоединяется к внешней транзакции.
+        # Соединение одно, поэтому задачи, запущенные внутри блока, не должны писать в БД параллельно
+        state = self.transaction_state.get()
+        if state:
+            yield state
+            return
+
+        async with self.acquire() as conn:
+            state = {'conn': conn, 'failed': False, 'committed': False, 'dropped': 0}
+            token = self.transaction_state.set(state)
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute('BEGIN')
+                yield state
+            except BaseException:
+                state['failed'] = True
+                raise
+            finally:
+                self.transaction_state.reset(token)
+                await self.finish_transaction(state)
+
+    async def finish_transaction(self, state: dict) -> None:
         try:
-            async with self.pg_con.acquire() as conn:
+            async with state['conn'].cursor() as cur:
+                await cur.execute('ROLLBACK' if state['failed'] else 'COMMIT')
+            state['committed'] = not state['failed']
+            if state['failed']:
+                await self.logger.log(f"Транзакция отменена из-за ошибки", level=LogLevel.WARNING)
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка завершения транзакции: {error}", level=LogLevel.ERROR)
+
+    async def execute_query(self, query, *args, fetch_all: bool = False, replica: bool = False):
+        # replica=True - только чтение, допускающее отставание реплики
+        return await self.timed_execute(query, args, 'all' if fetch_all else 'one', replica)
+
+    async def execute_command(self, query, *args, timeout: float | None = None) -> int | None:
+        # Для запросов без результата (DDL, UPDATE без RETURNING) возвращает количество затронутых строк.
+        # timeout заменяет таймаут пула для долгих служебных запросов
+        return await self.timed_execute(query, args, 'rowcount', timeout=timeout)
+
+    async def timed_execute(self, query, args: tuple, fetch: str, replica: bool = False,
+                            timeout: float | None = None):
+        # fetch: 'one' - первая строка, 'all' - все строки, 'rowcount' - количество затронутых строк
+        name = self.get_query_name()
+        replica = replica and self.has_replica() and not self.transaction_state.get()
+        result = None
+        rows = 0
+        started = time.perf_counter()
+        try:
+            async with self.connection(replica) as conn:
+                # Ожидание соединения учитывается отдельно, в статистику запроса идет только выполнение
+                started = time.perf_counter()
                 async with conn.cursor() as cur:
-                    await cur.execute(query, args)
-                    if fetch_all:
-                        return await cur.fetchall()
+                    await cur.execute(query, args, timeout=timeout)
+                    if fetch == 'all':
+                        result = await cur.fetchall()
+                        rows = len(result)
+                    elif fetch == 'one':
+                        result = await cur.fetchone()
+                        rows = 1 if result else 0
                     else:
-                        return await cur.fetchone()
+                        result = cur.rowcount
+                        rows = max(result, 0)
 
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка выполнения запроса: {error}", level=LogLevel.ERROR)
+            self.mark_transaction_failed()
+            self.query_stats.add_query(name, time.perf_counter() - started, failed=True)
+            if replica:
+                await self.logger.log(f"Ошибка чтения {name} с реплики, повтор на основной БД: {error}",
+                                      level=LogLevel.WARNING)
+                return await self.timed_execute(query, args, fetch)
+            await self.logger.log(f"Ошибка выполнения запроса {name}: {error}", level=LogLevel.ERROR)
             return None
 
-    async def create_user(self, tg_id, role_id, user_name, first_name, last_name, language_code, is_bot):
+        duration = time.perf_counter() - started
+        if self.query_stats.add_query(name, duration, rows):
+            query_text = ' '.join(query.split())
+            await self.logger.log(f"Медленный запрос {name}: {duration:.3f} с, строк {rows} - {query_text[:300]}",
+                                  level=LogLevel.WARNING)
+        return result
+
+    def get_query_name(self) -> str:
+        # Имя запроса - первый метод в цепочке вызовов, не являющийся служебным методом выполнения
+        frame = sys._getframe(2)
+        while frame and frame.f_code.co_name in self.stats_skip_frames:
+            frame = frame.f_back
+        return frame.f_code.co_name if frame else 'unknown'
+
+    async def log_query_stats(self, reset: bool = False) -> None:
+        await self.logger.log('\n'.join([self.query_stats.dump(), self.describe_pool(), self.users_cache.describe(),
+                                         self.cards_cache.describe()]), level=LogLevel.INFO)
+        if reset:
+            self.query_stats.reset()
+            self.pool_waiters_peak = self.pool_waiters
+            self.shed_requests = 0
+
+    def cache_result(self, cache: TTLCache, key, result) -> None:
+        # Пустой результат не кэшируется: отсутствующего пользователя сразу регистрируют.
+        # Прочитанное внутри транзакции может быть откачено, поэтому тоже не кэшируется
+        if result and not self.transaction_state.get():
+            cache.put(key, result)
+
+    def mark_transaction_failed(self) -> None:
+        # После ошибки PostgreSQL отклоняет остальные запросы транзакции, её можно только откатить
+        transaction = self.transaction_state.get()
+        if transaction:
+            transaction['failed'] = True
+
+    async def notify(self, channel: str, payload: str = '') -> None:
+        await self.execute_query("SELECT pg_notify(%s, %s)", channel, payload)
+
+    async def listen(self, channel: str, callback) -> None:
+        # Держит отдельное соединение из пула и передает payload каждого уведомления в callback.
+        # После переподключения callback вызывается с None: уведомления за время разрыва потеряны
+        reconnect = False
+        while True:
+            try:
+                async with self.pg_con.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(f"LISTEN {channel}")
+                    await self.logger.log(f"Подписка на уведомления {channel}", level=LogLevel.INFO)
+                    if reconnect:
+                        callback(None)
+                    while True:
+                        notification = await conn.notifies.get()
+                        callback(notification.payload)
+            except asyncio.CancelledError:
+                raise
+            except (Exception, psycopg2.Error) as error:
+                await self.logger.log(f"Ошибка прослушивания уведомлений {channel}: {error}", level=LogLevel.ERROR)
+                reconnect = True
+                await asyncio.sleep(self.listen_retry_delay)
+
+    async def sync_catalog_stores(self) -> None:
+        # Переписывает магазины каталога из stores_list и при изменении пересобирает catalog_stock
+        try:
+            store_uids = tuple(str(uid) for uid in stores_list)
+            async with self.transaction() as transaction:
+                if store_uids:
+                    deleted = await self.execute_command("DELETE FROM catalog_stores WHERE uid NOT IN %s", store_uids)
+                    added = await self.upsert_rows("INSERT INTO catalog_stores (uid) VALUES {values} "
+                                                   "ON CONFLICT (uid) DO NOTHING", [(uid,) for uid in store_uids])
+                else:
+                    deleted = await self.execute_command("DELETE FROM catalog_stores")
+                    added = 0
+            if transaction['committed'] and (deleted or added):
+                await self.logger.log(f"Магазины каталога изменены: {', '.join(store_uids)}", level=LogLevel.INFO)
+                await self.refresh_catalog_stock()
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка обновления магазинов каталога - {error}", level=LogLevel.ERROR)
+
+    async def refresh_catalog_stock(self) -> bool:
+        # CONCURRENTLY не блокирует чтение представления ботом на время пересборки.
+        # Время пересборки фиксируется той же транзакцией: изменения позже него бот еще не видит в представлении.
+        # Пересборку ограничивает только maintenance_timeout: statement_timeout снят, таймаут пула заменен
         try:
-            user_row = (tg_id, role_id, user_name, first_name, last_name, language_code, is_bot)
-            insert_user_query = """INSERT INTO users (tg_id, role_id, user_name, first_name, last_name, language_code, is_bot) 
-                                   VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING *"""
-            result = await self.execute_query(insert_user_query, *user_row)
+            async with self.transaction() as transaction:
+                await self.execute_command("SET LOCAL statement_timeout = 0")
+                if await self.execute_command("REFRESH MATERIALIZED VIEW CONCURRENTLY catalog_stock",
+                                              timeout=self.maintenance_timeout) is not None:
+                    await self.execute_command("UPDATE catalog_stock_state SET refreshed_at = now()")
+            return transaction['committed']
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка обновления catalog_stock - {error}", level=LogLevel.ERROR)
+            return False
+
+    async def get_sync_watermark(self, entity: str, full_sync_interval: float) -> tuple | None:
+        # (synced_to, пора ли полная сверка) для этапа синхронизации МойСклад
+        try:
+            get_sync_watermark_query = """SELECT synced_to, 
+                                                 full_synced_at IS NULL OR full_synced_at < now() - make_interval(secs => %s)
+                                          FROM sync_watermarks WHERE entity = %s"""
+            result = await self.execute_query(get_sync_watermark_query, full_sync_interval, entity)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления пользователя: {tg_id} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка получения отметки синхронизации {entity} - {error}", level=LogLevel.ERROR)
             return None
 
-    async def create_card(self, user_id, balance, file_id):
+    async def set_sync_watermark(self, entity: str, synced_to, full: bool = False) -> int | None:
+        # Отметка только сдвигается вперед, synced_to None оставляет прежнюю
         try:
-            card_row = (user_id, balance, file_id)
-            insert_card_query = """INSERT INTO cards (user_id, balance, file_id) VALUES (%s, %s, %s) RETURNING *"""
-            result = await self.execute_query(insert_card_query, *card_row)
+            set_sync_watermark_query = """INSERT INTO sync_watermarks (entity, synced_to, full_synced_at) 
+                                          VALUES (%s, %s, CASE WHEN %s THEN now() END)
+                                          ON CONFLICT (entity) DO UPDATE
+                                          SET synced_to = GREATEST(sync_watermarks.synced_to, EXCLUDED.synced_to),
+                                              full_synced_at = COALESCE(EXCLUDED.full_synced_at, 
+                                                                        sync_watermarks.full_synced_at),
+                                              updated_at = now()"""
+            result = await self.execute_command(set_sync_watermark_query, entity, synced_to, full)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления карты пользователя: {user_id} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка записи отметки синхронизации {entity} - {error}", level=LogLevel.ERROR)
             return None
 
-    async def add_store(self, uid: str, name: str) -> None | list:
+    async def load_users_schema(self) -> None:
+        role = await self.get_role('USER')
+        self.user_role_id = role[0] if role else None
+        if self.user_role_id is None:
+            await self.logger.log(f"Не найдена роль USER", level=LogLevel.ERROR)
+
+        get_users_columns_query = """SELECT column_name FROM information_schema.columns
+                                      WHERE table_schema = current_schema() AND table_name = 'users'
+                                      ORDER BY ordinal_position"""
+        result = await self.execute_query(get_users_columns_query, fetch_all=True)
+        self.users_columns = [row[0] for row in result] if result else []
+
+    async def upsert_user(self, tg_id, user_name, first_name, last_name, language_code, is_bot):
+        # Регистрация одним запросом: новый пользователь создается с ролью USER, у существующего
+        # обновляются данные профиля. Повторные и одновременные первые нажатия не создают дублей
+        if self.user_role_id is None:
+            await self.load_users_schema()
+            if self.user_role_id is None:
+                return None
         try:
-            store_row = (uid, name)
-            insert_store_query = """INSERT INTO stores (uid, name) VALUES (%s, %s) 
-                                    ON CONFLICT (uid) DO UPDATE
-                                    SET name = EXCLUDED.name
-                                    RETURNING *"""
-            result = await self.execute_query(insert_store_query, *store_row)
+            user_row = (tg_id, self.user_role_id, user_name, first_name, last_name, language_code, is_bot)
+            upsert_user_query = """INSERT INTO users (tg_id, role_id, user_name, first_name, last_name, language_code, is_bot) 
+                                   VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                   ON CONFLICT (tg_id) DO UPDATE
+                                   SET user_name = EXCLUDED.user_name, first_name = EXCLUDED.first_name,
+                                       last_name = EXCLUDED.last_name, language_code = EXCLUDED.language_code
+                                   RETURNING *"""
+            result = await self.execute_query(upsert_user_query, *user_row)
+            self.mark_written(('tg', tg_id), *([('user', result[0])] if result else []))
+            self.users_cache.discard(tg_id)
+            self.cache_result(self.users_cache, tg_id, result)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления склада: {uid} {name} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка регистрации пользователя: {tg_id} - {error}", level=LogLevel.ERROR)
             return None
 
-    async def add_uom(self, uid: str, name: str, description: str) -> None | list:
+    async def upsert_rows(self, insert_query: str, rows: list, key_size: int = 1,
+                          returning: bool = False) -> int | list | None:
+        # Пачка строк одним запросом INSERT ... VALUES (...), (...) вместо запроса на каждую строку,
+        # место для списка значений в insert_query обозначается {values}.
+        # Без returning возвращает количество добавленных и измененных строк, с returning - сами строки.
+        # ON CONFLICT не допускает повтор ключа в одном запросе, поэтому из дублей остается последняя строка.
+        # Пропущенные из-за ошибки строки добавляются в state['dropped'] транзакции: синхронизация
+        # по нему не сдвигает отметку и запрашивает эти строки повторно
+        rows = list({tuple(row[:key_size]): tuple(row) for row in rows}.values())
+        result = [] if returning else 0
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start:start + self.batch_size]
+            chunk_result = await self.upsert_chunk(insert_query, chunk, returning)
+            if chunk_result is None and len(chunk) > 1:
+                # Одна ошибочная строка (например, ссылка на еще не загруженный товар) отменяет всю пачку,
+                # поэтому пачка повторяется построчно и теряются только ошибочные строки
+                await self.logger.log(f"Пакетная запись {len(chunk)} строк не удалась, запись построчно",
+                                      level=LogLevel.WARNING)
+                chunk_result = [] if returning else 0
+                dropped = 0
+                for row in chunk:
+                    row_result = await self.upsert_chunk(insert_query, [row], returning)
+                    if row_result is None:
+                        dropped += 1
+                    else:
+                        chunk_result += row_result
+                if dropped:
+                    await self.logger.log(f"Не записано строк: {dropped} из {len(chunk)}", level=LogLevel.WARNING)
+                    transaction = self.transaction_state.get()
+                    if transaction:
+                        transaction['dropped'] += dropped
+            if chunk_result is None:
+                return None
+            result += chunk_result
+        return result
+
+    async def upsert_chunk(self, insert_query: str, chunk: list, returning: bool) -> int | list | None:
+        row_placeholder = '(' + ', '.join(['%s'] * len(chunk[0])) + ')'
+        query = insert_query.format(values=', '.join([row_placeholder] * len(chunk)))
+        args = [value for row in chunk for value in row]
+        # В транзакции пачка пишется под точкой сохранения, чтобы ошибка пачки не отменяла всю транзакцию
+        transaction = self.transaction_state.get()
+        if transaction and await self.execute_command('SAVEPOINT upsert_chunk') is None:
+            return None
+        if returning:
+            result = await self.execute_query(query + ' RETURNING *', *args, fetch_all=True)
+        else:
+            result = await self.execute_command(query, *args)
+        if transaction:
+            if result is None:
+                if await self.execute_command('ROLLBACK TO SAVEPOINT upsert_chunk') is not None:
+                    transaction['failed'] = False
+            else:
+                await self.execute_command('RELEASE SAVEPOINT upsert_chunk')
+        return result
+
+    async def add_stores(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (uid, name)
         try:
-            uom_row = (uid, name, description)
-            insert_uom_query = """INSERT INTO uoms (uid, name, description) VALUES (%s, %s, %s) 
-                                  ON CONFLICT (uid) DO UPDATE
-                                  SET name = EXCLUDED.name, description = EXCLUDED.description
-                                  RETURNING *"""
-            result = await self.execute_query(insert_uom_query, *uom_row)
+            insert_stores_query = """INSERT INTO stores (uid, name) VALUES {values} 
+                                     ON CONFLICT (uid) DO UPDATE
+                                     SET name = EXCLUDED.name
+                                     WHERE stores.name IS DISTINCT FROM EXCLUDED.name"""
+            result = await self.upsert_rows(insert_stores_query, rows, returning=returning)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления единицы измерения: {uid} {name} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка добавления складов: {len(rows)} шт. - {error}", level=LogLevel.ERROR)
             return None
 
-    async def add_product_folder(self, uid: str, parent_uid: str | None, name: str) -> None | list:
+    async def add_uoms(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (uid, name, description)
         try:
-            product_folder_row = (uid, parent_uid, name)
-            insert_product_folder_query = """INSERT INTO product_groups (uid, parent_uid, name) VALUES (%s, %s, %s) 
-                                             ON CONFLICT (uid) DO UPDATE
-                                             SET parent_uid = EXCLUDED.parent_uid, name = EXCLUDED.name
-                                             RETURNING *"""
-            result = await self.execute_query(insert_product_folder_query, *product_folder_row)
+            insert_uoms_query = """INSERT INTO uoms (uid, name, description) VALUES {values} 
+                                   ON CONFLICT (uid) DO UPDATE
+                                   SET name = EXCLUDED.name, description = EXCLUDED.description"""
+            result = await self.upsert_rows(insert_uoms_query, rows, returning=returning)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления группы товаров: {uid} {name} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка добавления единиц измерения: {len(rows)} шт. - {error}",
+                                  level=LogLevel.ERROR)
             return None
 
-    async def add_product(self, uid: str, group_uid: str, uom_uid: str, name: str, buy_price: float | int,
-                          sales_price: float | int) -> None | list:
-        try:
-            uom = await self.get_uom(uom_uid)
-            if not uom:
-                uom_uid = None
-
-            product_row = (uid, group_uid, uom_uid, name, buy_price, sales_price)
-            insert_product_query = """INSERT INTO products (uid, group_uid, uom_uid, name, buy_price, sales_price) 
-                                      VALUES (%s, %s, %s, %s, %s, %s) 
-                                      ON CONFLICT (uid) DO UPDATE
-                                      SET group_uid = EXCLUDED.group_uid, uom_uid = EXCLUDED.uom_uid, 
-                                          name = EXCLUDED.name, buy_price = EXCLUDED.buy_price, 
-                                          sales_price = EXCLUDED.sales_price
-                                      RETURNING *"""
-            result = await self.execute_query(insert_product_query, *product_row)
+    async def add_product_folders(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (uid, parent_uid, name)
+        try:
+            insert_product_folders_query = """INSERT INTO product_groups (uid, parent_uid, name) VALUES {values} 
+                                              ON CONFLICT (uid) DO UPDATE
+                                              SET parent_uid = EXCLUDED.parent_uid, name = EXCLUDED.name,
+                                                  updated_at = now()
+                                              WHERE (product_groups.parent_uid, product_groups.name)
+                                                    IS DISTINCT FROM (EXCLUDED.parent_uid, EXCLUDED.name)"""
+            result = await self.upsert_rows(insert_product_folders_query, rows, returning=returning)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления товара: {uid} {name} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка добавления групп товаров: {len(rows)} шт. - {error}",
+                                  level=LogLevel.ERROR)
             return None
 
-    async def add_product_remains(self, product_uid: str, store_uid: str, count: float | int) -> None | list:
+    async def add_products(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (uid, group_uid, uom_uid, name, buy_price, sales_price).
+        # Единицы измерения проверяются одним запросом на всю пачку, неизвестные заменяются на NULL
         try:
-            product_remains_row = (product_uid, store_uid, count)
-            insert_product_remains_query = """INSERT INTO product_remains (product_uid, store_uid, count) 
-                                      VALUES (%s, %s, %s) 
-                                      ON CONFLICT (product_uid, store_uid) DO UPDATE
-                                      SET count = EXCLUDED.count
-                                      RETURNING *"""
-            result = await self.execute_query(insert_product_remains_query, *product_remains_row)
+            uom_uids = tuple({row[2] for row in rows if row[2]})
+            known_uoms = await self.get_uoms_uids(uom_uids) if uom_uids else set()
+            if known_uoms is None:
+                return None
+            rows = [(uid, group_uid, uom_uid if uom_uid in known_uoms else None, name, buy_price, sales_price)
+                    for uid, group_uid, uom_uid, name, buy_price, sales_price in rows]
+
+            insert_products_query = """INSERT INTO products (uid, group_uid, uom_uid, name, buy_price, sales_price) 
+                                       VALUES {values} 
+                                       ON CONFLICT (uid) DO UPDATE
+                                       SET group_uid = EXCLUDED.group_uid, uom_uid = EXCLUDED.uom_uid, 
+                                           name = EXCLUDED.name, buy_price = EXCLUDED.buy_price, 
+                                           sales_price = EXCLUDED.sales_price, updated_at = now(),
+                                           prev_group_uid = CASE WHEN products.group_uid IS DISTINCT FROM 
+                                                                      EXCLUDED.group_uid 
+                                                                 THEN products.group_uid::text
+                                                                 ELSE products.prev_group_uid END
+                                       WHERE (products.group_uid, products.uom_uid, products.name, 
+                                              products.buy_price, products.sales_price) 
+                                             IS DISTINCT FROM (EXCLUDED.group_uid, EXCLUDED.uom_uid, EXCLUDED.name,
+                                                               EXCLUDED.buy_price, EXCLUDED.sales_price)"""
+            result = await self.upsert_rows(insert_products_query, rows, returning=returning)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления остатка товара product_uid: {product_uid}, "
-                                  f"store_uid: {store_uid} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка добавления товаров: {len(rows)} шт. - {error}", level=LogLevel.ERROR)
+            return None
+
+    async def get_product_uids(self) -> set | None:
+        try:
+            result = await self.execute_query("SELECT uid::text FROM products", fetch_all=True)
+            return {row[0] for row in result} if result is not None else None
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка получения списка товаров - {error}", level=LogLevel.ERROR)
             return None
 
-    async def add_bonus_operation(self, card_id, operation_id, moment_operation, points_earned) -> None | list:
+    async def add_products_remains(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (product_uid, store_uid, count)
         try:
-            bonus_operation_row = (operation_id, card_id, points_earned, moment_operation)
-            insert_bonus_operation_query = """INSERT INTO bonus_operations (operation_id, card_id, points_earned, 
-                                                                            moment_operation) 
-                                              VALUES (%s, %s, %s, %s) 
-                                              ON CONFLICT (operation_id) DO NOTHING 
-                                              RETURNING *"""
-            result = await self.execute_query(insert_bonus_operation_query, *bonus_operation_row)
+            insert_products_remains_query = """INSERT INTO product_remains (product_uid, store_uid, count) 
+                                               VALUES {values} 
+                                               ON CONFLICT (product_uid, store_uid) DO UPDATE
+                                               SET count = EXCLUDED.count, updated_at = now()
+                                               WHERE product_remains.count IS DISTINCT FROM EXCLUDED.count"""
+            result = await self.upsert_rows(insert_products_remains_query, rows, key_size=2, returning=returning)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка добавления бонусной операции: {operation_id}, "
-                                  f"card_id: {card_id} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка добавления остатков товаров: {len(rows)} шт. - {error}",
+                                  level=LogLevel.ERROR)
+            return None
+
+    async def add_bonus_operations(self, rows: list, returning: bool = False) -> int | list | None:
+        # rows: (operation_id, card_id, points_earned, moment_operation), уже записанные операции пропускаются
+        try:
+            insert_bonus_operations_query = """INSERT INTO bonus_operations (operation_id, card_id, points_earned, 
+                                                                             moment_operation) 
+                                               VALUES {values} 
+                                               ON CONFLICT (operation_id) DO NOTHING"""
+            result = await self.upsert_rows(insert_bonus_operations_query, rows, returning=returning)
+            return result
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка добавления бонусных операций: {len(rows)} шт. - {error}",
+                                  level=LogLevel.ERROR)
             return None
 
     async def get_role(self, role_name):
         try:
             get_role_query = """SELECT * FROM roles WHERE role = %s"""
-            result = await self.execute_query(get_role_query, role_name)
+            result = await self.execute_query(get_role_query, role_name, replica=True)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
             await self.logger.log(f"Ошибка получения роли: {role_name} - {error}", level=LogLevel.ERROR)
             return None
 
     async def get_user(self, tg_id):
+        user = self.users_cache.get(tg_id)
+        if user is not TTLCache.MISSING:
+            return user
         try:
-            get_user_query = """SELECT * FROM users WHERE tg_id = %s"""
-            result = await self.execute_query(get_user_query, tg_id)
+            result = await self.execute_query(self.get_user_query, tg_id, replica=self.read_from_replica(('tg', tg_id)))
+            self.cache_result(self.users_cache, tg_id, result)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
             await self.logger.log(f"Ошибка получения пользователя: {tg_id} - {error}", level=LogLevel.ERROR)
             return None
 
     async def get_card(self, user_id):
+        card = self.cards_cache.get(user_id)
+        if card is not TTLCache.MISSING:
+            return None if card is self.no_card else card
         try:
-            get_card_query = """SELECT * FROM cards WHERE user_id = %s"""
-            result = await self.execute_query(get_card_query, user_id)
+            result = await self.execute_query(self.get_card_query, user_id,
+                                              replica=self.read_from_replica(('user', user_id)))
+            self.cache_result(self.cards_cache, user_id, result)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
             await self.logger.log(f"Ошибка получения карты пользователя: {user_id} - {error}", level=LogLevel.ERROR)
             return None
 
-    async def get_card_by_number(self, card_number):
+    def get_user_with_card_query(self) -> str:
+        return f"""SELECT u.*, c.* FROM users u
+                   LEFT JOIN cards c ON c.user_id = u."{self.users_columns[0]}"
+                   WHERE u.tg_id = %s LIMIT 1"""
+
+    async def get_user_with_card(self, tg_id) -> tuple:
+        # Пользователь и его карта одним запросом, (None, None) если пользователя нет.
+        # Карта None, если она еще не создана
+        user = self.users_cache.get(tg_id)
+        if user is not TTLCache.MISSING:
+            card = self.cards_cache.get(user[0])
+            if card is not TTLCache.MISSING:
+                return user, None if card is self.no_card else card
+        if not self.users_columns:
+            user = await self.get_user(tg_id)
+            return user, await self.get_card(user[0]) if user else None
         try:
-            get_card_query = """SELECT * FROM cards WHERE uid = %s LIMIT 1"""
-            result = await self.execute_query(get_card_query, card_number)
+            keys = [('tg', tg_id)] + ([('user', user[0])] if user is not TTLCache.MISSING else [])
+            result = await self.execute_query(self.get_user_with_card_query(), tg_id,
+                                              replica=self.read_from_replica(*keys))
+            if not result:
+                return None, None
+            user = tuple(result[:len(self.users_columns)])
+            card = tuple(result[len(self.users_columns):])
+            # У пользователя без карты все столбцы карты NULL
+            card = card if any(value is not None for value in card) else None
+            self.cache_result(self.users_cache, tg_id, user)
+            # Отсутствие карты тоже кэшируется, иначе пользователь без карты шел бы в БД на каждое нажатие
+            self.cache_result(self.cards_cache, user[0], card or self.no_card)
+            return user, card
+        except PoolSaturated:
+            raise
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка получения пользователя с картой: {tg_id} - {error}", level=LogLevel.ERROR)
+            return None, None
+
+    async def get_or_create_card(self, user_id):
+        # Существующая карта пользователя или новая с нулевым балансом одним запросом.
+        # ON CONFLICT без столбцов не требует индекса cards_user_id_key: пока дубли карт не объединены,
+        # повторную карту не дает создать NOT EXISTS. Запрос видит только данные на свой старт,
+        # поэтому при одновременном создании второй вызов может не вернуть строку - тогда карта перечитывается
+        try:
+            get_or_create_card_query = """WITH new_card AS (
+                                              INSERT INTO cards (user_id, balance, file_id) 
+                                              SELECT %s, 0, '' 
+                                              WHERE NOT EXISTS (SELECT 1 FROM cards WHERE user_id = %s)
+                                              ON CONFLICT DO NOTHING
+                                              RETURNING *
+                                          )
+                                          SELECT * FROM new_card
+                                          UNION ALL
+                                          SELECT * FROM cards WHERE user_id = %s
+                                          LIMIT 1"""
+            result = await self.execute_query(get_or_create_card_query, user_id, user_id, user_id)
+            self.mark_written(('user', user_id))
+            # Закэшированное "карты нет" больше не верно, даже если запрос не вернул строку
+            self.cards_cache.discard(user_id)
+            if not result:
+                return await self.get_card(user_id)
+            self.cache_result(self.cards_cache, user_id, result)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка получения карты: {card_number} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка получения или создания карты пользователя: {user_id} - {error}",
+                                  level=LogLevel.ERROR)
             return None
 
-    async def get_uom(self, uid: str) -> None | list:
+    def get_bonus_history_query(self, after_operation: bool) -> str:
+        # Следующая страница начинается после операции-курсора: ключ (время, id) берется из самой
+        # операции, поэтому запрос идет по индексу с любого места истории без OFFSET
+        where_after = """ AND (moment_operation, operation_id) < 
+                              (SELECT moment_operation, operation_id FROM bonus_operations 
+                               WHERE operation_id = %s)""" if after_operation else ''
+        return f"""SELECT operation_id, moment_operation, points_earned 
+                   FROM bonus_operations 
+                   WHERE card_id = %s{where_after}
+                   ORDER BY moment_operation DESC, operation_id DESC
+                   LIMIT %s"""
+
+    async def get_bonus_history(self, card_id, after_operation_id=None, limit: int = 10) -> list | None:
+        # Операции карты от новых к старым: (operation_id, moment_operation, points_earned),
+        # страница после операции after_operation_id
         try:
-            get_uom_query = """SELECT * FROM uoms WHERE uid = %s"""
-            result = await self.execute_query(get_uom_query, uid)
+            params = [card_id, after_operation_id] if after_operation_id else [card_id]
+            result = await self.execute_query(self.get_bonus_history_query(bool(after_operation_id)), *params, limit,
+                                              fetch_all=True, replica=True)
             return result
+        except PoolSaturated:
+            raise
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка получения истории бонусов карты: {card_id} - {error}",
+                                  level=LogLevel.ERROR)
+            return None
+
+    async def get_card_ids(self) -> dict | None:
+        # Номер карты -> id карты для сопоставления операций МойСклад без запроса на каждую операцию
+        try:
+            result = await self.execute_query("SELECT uid::text, id FROM cards", fetch_all=True)
+            return dict(result) if result is not None else None
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка получения списка карт - {error}", level=LogLevel.ERROR)
+            return None
+
+    async def get_uoms_uids(self, uids: tuple) -> set | None:
+        try:
+            get_uoms_uids_query = """SELECT uid::text FROM uoms WHERE uid IN %s"""
+            result = await self.execute_query(get_uoms_uids_query, uids, fetch_all=True)
+            return {row[0] for row in result} if result is not None else None
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка получения единицы измерения uid: {uid} - {error}", level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка получения единиц измерения: {len(uids)} шт. - {error}",
+                                  level=LogLevel.ERROR)
             return None
 
-    async def get_groups_by_parent(self, parent_uid: str | None, except_groups=None) -> None | list:
+    async def get_groups_tree(self, except_groups=None) -> None | list:
         if except_groups is None:
             except_groups = []
         try:
-            where = 'WHERE parent_uid IS NULL' if not parent_uid else 'WHERE parent_uid = %s'
-            params = () if not parent_uid else (parent_uid,)
+            # Исключенные группы отсекаются вместе со всеми своими подгруппами
+            where = ' AND pg.name NOT IN %s' if except_groups else ''
+            params = (tuple(except_groups), tuple(except_groups)) if except_groups else ()
 
-            if except_groups:
-                where += ' AND name NOT IN %s'
-                params += (tuple(except_groups),)
+            # Всё дерево групп одним рекурсивным запросом, дочерние группы идут раньше родительских
+            get_groups_tree_query = f"""
+                WITH RECURSIVE tree AS (
+                    SELECT pg.uid, pg.parent_uid, pg.name, 1 AS level
+                    FROM product_groups pg
+                    WHERE pg.parent_uid IS NULL{where}
+                    UNION ALL
+                    SELECT pg.uid, pg.parent_uid, pg.name, tree.level + 1
+                    FROM product_groups pg
+                    JOIN tree ON pg.parent_uid = tree.uid
+                    WHERE TRUE{where}
+                )
+                SELECT uid, parent_uid, name, level FROM tree ORDER BY level DESC
+            """
+            result = await self.execute_query(get_groups_tree_query, *params, fetch_all=True, replica=True)
+            return result
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка получения дерева групп товаров - {error}", level=LogLevel.ERROR)
+            return None
+
+    def get_catalog_remains_query(self, by_groups: bool) -> str:
+        where_groups = 'WHERE group_uid IN %s' if by_groups else ''
+        return f"""
+            SELECT group_uid, product_uid, product_name, store_name, count
+            FROM catalog_stock {where_groups}
+            ORDER BY product_name, store_name
+        """
 
-            get_groups_query = f"""SELECT uid, name FROM product_groups {where}"""
-            result = await self.execute_query(get_groups_query, *params, fetch_all=True)
+    async def get_catalog_remains(self, group_uids: list | None = None) -> list | None:
+        try:
+            # Положительные остатки товаров по магазинам из stores_list из представления catalog_stock,
+            # при переданных group_uids - только товары этих групп
+            params = [tuple(str(uid) for uid in group_uids)] if group_uids else []
+            result = await self.execute_query(self.get_catalog_remains_query(bool(group_uids)), *params,
+                                              fetch_all=True, replica=True)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка получения группы товаров parent_uid: {parent_uid} - {error}",
-                                  level=LogLevel.ERROR)
+            await self.logger.log(f"Ошибка получения остатков каталога - {error}", level=LogLevel.ERROR)
             return None
 
-    async def get_products_by_group(self, group_uid: str) -> list | None:
+    async def get_catalog_changes(self, since, until=None) -> list | None:
         try:
-            get_products_query = """SELECT uid, name FROM products WHERE group_uid = %s"""
-            result = await self.execute_query(get_products_query, group_uid, fetch_all=True)
+            params = (since, since, until, until, since, until, until)
+            result = await self.execute_query(self.get_catalog_changes_query, *params, fetch_all=True, replica=True)
             return result
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(f"Ошибка получения товаров по группе group_uid: {group_uid} - {error}",
+            await self.logger.log(f"Ошибка получения изменений каталога since: {since} - {error}",
                                   level=LogLevel.ERROR)
             return None
 
-    async def get_product_remains(self, product_uid: str) -> list | None:
-
+    async def get_catalog_watermark(self):
+        # Время, до которого изменения каталога видны в catalog_stock
         try:
-            get_products_query = f"""
-                SELECT st.name, pr.count, st.uid 
-                FROM product_remains pr
-                JOIN stores st ON pr.product_uid = %s AND pr.store_uid = st.uid
-                WHERE pr.count > 0 AND st.uid IN ({', '.join(['%s'] * len(stores_list))})
-            """
-            # Параметры для SQL запроса (uid продукта + список магазинов)
-            params = [product_uid] + stores_list
-            result = await self.execute_query(get_products_query, *params, fetch_all=True)
-            return result
+            get_catalog_watermark_query = """SELECT LEAST(now(), (SELECT refreshed_at FROM catalog_stock_state))"""
+            result = await self.execute_query(get_catalog_watermark_query, replica=True)
+            return result[0] if result else None
         except (Exception, psycopg2.Error) as error:
-            await self.logger.log(
-                f"Ошибка получения остатков товара product_uid: {product_uid} - {error}",
-                level=LogLevel.ERROR
-            )
+            await self.logger.log(f"Ошибка получения времени обновления каталога - {error}", level=LogLevel.ERROR)
             return None
 
     async def set_card_file_id(self, user_id, file_id):
         try:
             set_card_file_id_query = """UPDATE cards SET file_id = %s WHERE user_id = %s RETURNING *"""
             result = await self.execute_query(set_card_file_id_query, file_id, user_id)
+            self.mark_written(('user', user_id))
+            self.cards_cache.discard(user_id)
             return result
+        except PoolSaturated:
+            raise
         except (Exception, psycopg2.Error) as error:
             await self.logger.log(f"Ошибка установки идентификатора файла карты пользователя: {user_id} - {error}",
                                   level=LogLevel.ERROR)
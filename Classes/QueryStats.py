@@ -0,0 +1,99 @@
+import time
+from bisect import bisect_left
+
+
+class QueryStatsEntry:
+    __slots__ = ('count', 'errors', 'rows', 'total', 'max', 'histogram')
+
+    def __init__(self, buckets_count: int):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Количество замеров по корзинам QueryStats.buckets, последняя корзина - всё, что дольше
+        self.histogram = [0] * (buckets_count + 1)
+
+    def add(self, duration: float, bucket: int, rows: int = 0, failed: bool = False) -> None:
+        self.count += 1
+        self.rows += rows
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.histogram[bucket] += 1
+        if failed:
+            self.errors += 1
+
+    def percentile(self, buckets: tuple, ratio: float) -> float:
+        # Оценка по гистограмме: верхняя граница корзины, в которую попал перцентиль
+        position = ratio * self.count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= position:
+                return min(buckets[bucket], self.max) if bucket < len(buckets) else self.max
+        return 0.0
+
+
+# Статистика запросов к БД по именам (метод PGMgr, из которого выполнен запрос)
+# и время ожидания свободного соединения пула
+class QueryStats:
+    # Границы корзин гистограммы длительности в секундах
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, slow_query_threshold: float):
+        # Запросы дольше порога (в секундах) пишутся в лог, 0 - не писать
+        self.slow_query_threshold = slow_query_threshold
+        self.queries: dict[str, QueryStatsEntry] = {}
+        self.pool_wait = QueryStatsEntry(len(self.buckets))
+        self.started_at = time.time()
+
+    def reset(self) -> None:
+        self.queries = {}
+        self.pool_wait = QueryStatsEntry(len(self.buckets))
+        self.started_at = time.time()
+
+    def add_query(self, name: str, duration: float, rows: int = 0, failed: bool = False) -> bool:
+        # Возвращает True, если запрос медленный
+        entry = self.queries.get(name)
+        if entry is None:
+            entry = self.queries[name] = QueryStatsEntry(len(self.buckets))
+        entry.add(duration, bisect_left(self.buckets, duration), rows, failed)
+        return 0 < self.slow_query_threshold <= duration
+
+    def add_pool_wait(self, duration: float) -> None:
+        self.pool_wait.add(duration, bisect_left(self.buckets, duration))
+
+    def to_dict(self) -> dict:
+        def describe(entry: QueryStatsEntry) -> dict:
+            return {
+                'count': entry.count,
+                'errors': entry.errors,
+                'rows': entry.rows,
+                'total': round(entry.total, 6),
+                'avg': round(entry.total / entry.count, 6) if entry.count else 0.0,
+                'p50': entry.percentile(self.buckets, 0.5),
+                'p95': entry.percentile(self.buckets, 0.95),
+                'p99': entry.percentile(self.buckets, 0.99),
+                'max': round(entry.max, 6),
+                'histogram': dict(zip([f'<={bucket}' for bucket in self.buckets] + ['>'], entry.histogram))
+            }
+
+        return {
+            'period': round(time.time() - self.started_at, 3),
+            'pool_wait': describe(self.pool_wait),
+            'queries': {name: describe(entry) for name, entry in self.queries.items()}
+        }
+
+    def dump(self) -> str:
+        # Текстовая таблица, запросы отсортированы по суммарному времени
+        stats = self.to_dict()
+        lines = [f"Статистика запросов за {stats['period']:.0f} с",
+                 f"{'запрос':<32}{'кол-во':>9}{'ошибок':>8}{'строк':>10}{'всего, с':>11}"
+                 f"{'сред, мс':>10}{'p95, мс':>10}{'макс, мс':>10}"]
+        rows = [('ожидание пула', stats['pool_wait'])]
+        rows += sorted(stats['queries'].items(), key=lambda item: item[1]['total'], reverse=True)
+        for name, entry in rows:
+            lines.append(f"{name[:31]:<32}{entry['count']:>9}{entry['errors']:>8}{entry['rows']:>10}"
+                         f"{entry['total']:>11.3f}{entry['avg'] * 1000:>10.1f}{entry['p95'] * 1000:>10.1f}"
+                         f"{entry['max'] * 1000:>10.1f}")
+        return '\n'.join(lines)
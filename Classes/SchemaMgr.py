@@ -0,0 +1,230 @@
+import asyncio
+import sys
+from datetime import datetime, timezone
+import psycopg2
+from Classes.Logger import Logger, LogLevel
+
+
+# Версионные миграции схемы БД и проверка планов горячих запросов.
+# Миграции применяются по порядку при подключении, каждая - одной транзакцией,
+# примененные версии записываются в schema_migrations. Запросы миграций идемпотентны,
+# поэтому их можно накатить и на базу, где часть объектов уже создана вручную
+# Значения параметров для EXPLAIN горячих запросов
+EXPLAIN_UID = '00000000-0000-0000-0000-000000000000'
+EXPLAIN_TIME = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+class SchemaMgr:
+    # Ключ блокировки, чтобы бот и синхронизация не накатывали миграции одновременно
+    migrations_lock_key = 7_301_015
+    # (версия, название, запросы)
+    migrations = [
+        (1, 'catalog_tracking', [
+            # Время последнего изменения строк каталога, по нему бот пересобирает только изменившиеся группы.
+            # prev_group_uid хранит прежнюю группу товара, чтобы при переносе пересобрать и её
+            "ALTER TABLE product_groups ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()",
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()",
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS prev_group_uid text",
+            "ALTER TABLE product_remains ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()",
+            "CREATE INDEX IF NOT EXISTS product_groups_updated_at_idx ON product_groups (updated_at)",
+            "CREATE INDEX IF NOT EXISTS products_updated_at_idx ON products (updated_at)",
+            "CREATE INDEX IF NOT EXISTS product_remains_updated_at_idx ON product_remains (updated_at)"
+        ]),
+        (2, 'hot_path_indexes', [
+            # Покрывающие индексы: списки подгрупп и товаров группы читаются без обращения к таблице
+            "CREATE INDEX IF NOT EXISTS product_groups_parent_uid_idx ON product_groups (parent_uid) "
+            "INCLUDE (uid, name)",
+            "CREATE INDEX IF NOT EXISTS products_group_uid_idx ON products (group_uid) INCLUDE (uid, name)",
+            # Частичный индекс только по ненулевым остаткам - бот читает только их
+            "CREATE INDEX IF NOT EXISTS product_remains_in_stock_idx ON product_remains (product_uid, store_uid) "
+            "INCLUDE (count) WHERE count > 0",
+            "CREATE INDEX IF NOT EXISTS cards_uid_idx ON cards (uid)"
+        ]),
+        (3, 'users_keys', [
+            # Регистрация не добавит новый дубль, пока дубли объединяются
+            "LOCK TABLE users, cards IN SHARE ROW EXCLUSIVE MODE",
+            # Дубли от гонки регистрации до upsert_user объединяются: из пользователей с одним tg_id
+            # остается первый, карты остальных переносятся на него, и ни одна карта не удаляется
+            """UPDATE cards c SET user_id = kept.id
+               FROM users u
+               JOIN (SELECT tg_id, min(id) AS id FROM users GROUP BY tg_id) kept ON kept.tg_id = u.tg_id
+               WHERE c.user_id = u.id AND u.id <> kept.id""",
+            """DELETE FROM users u
+               USING (SELECT tg_id, min(id) AS id FROM users GROUP BY tg_id) kept
+               WHERE u.tg_id = kept.tg_id AND u.id <> kept.id""",
+            # Уникальный ключ для регистрации через ON CONFLICT: один пользователь на tg_id
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_tg_id_key ON users (tg_id)"
+        ]),
+        (4, 'catalog_stock', [
+            # Магазины из stores_list, PGMgr.sync_catalog_stores переписывает их из конфига при подключении
+            "CREATE TABLE IF NOT EXISTS catalog_stores (uid text PRIMARY KEY)",
+            # Готовые строки каталога бота: только положительные остатки в магазинах каталога
+            """CREATE MATERIALIZED VIEW IF NOT EXISTS catalog_stock AS
+               SELECT p.group_uid::text AS group_uid, p.uid::text AS product_uid, p.name AS product_name,
+                      st.uid::text AS store_uid, st.name AS store_name, pr.count
+               FROM product_remains pr
+               JOIN products p ON p.uid = pr.product_uid
+               JOIN stores st ON st.uid = pr.store_uid
+               JOIN catalog_stores cs ON cs.uid = st.uid::text
+               WHERE pr.count > 0""",
+            # Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+            "CREATE UNIQUE INDEX IF NOT EXISTS catalog_stock_key ON catalog_stock (product_uid, store_uid)",
+            "CREATE INDEX IF NOT EXISTS catalog_stock_group_uid_idx ON catalog_stock (group_uid)",
+            # Время БД, на которое построено представление
+            """CREATE TABLE IF NOT EXISTS catalog_stock_state (
+                   id boolean PRIMARY KEY DEFAULT true CHECK (id),
+                   refreshed_at timestamptz NOT NULL
+               )""",
+            "INSERT INTO catalog_stock_state (id, refreshed_at) VALUES (true, now()) ON CONFLICT (id) DO NOTHING"
+        ]),
+        (5, 'bonus_history_index', [
+            # История бонусов карты листается по ключу (moment_operation, operation_id) от новых к старым
+            "CREATE INDEX IF NOT EXISTS bonus_operations_card_history_idx "
+            "ON bonus_operations (card_id, moment_operation DESC, operation_id DESC) INCLUDE (points_earned)"
+        ]),
+        (6, 'sync_watermarks', [
+            # Докуда загружены изменения МойСклад по каждому этапу синхронизации (время МойСклад)
+            # и когда этап последний раз сверялся полностью
+            """CREATE TABLE IF NOT EXISTS sync_watermarks (
+                   entity text PRIMARY KEY,
+                   synced_to timestamp,
+                   full_synced_at timestamptz,
+                   updated_at timestamptz NOT NULL DEFAULT now()
+               )"""
+        ]),
+        (7, 'cards_user_key', [
+            "LOCK TABLE cards IN SHARE ROW EXCLUSIVE MODE",
+            # Из нескольких карт пользователя удаляются только пустые: без баланса, изображения
+            # и бонусных операций. Остается карта с данными, а если пустые все - первая
+            """DELETE FROM cards c
+               USING (SELECT id, row_number() OVER (PARTITION BY user_id ORDER BY is_empty, id) AS position,
+                             is_empty
+                      FROM (SELECT id, user_id,
+                                   COALESCE(balance, 0) = 0 AND COALESCE(file_id, '') = ''
+                                   AND NOT EXISTS (SELECT 1 FROM bonus_operations b WHERE b.card_id = cards.id)
+                                   AS is_empty
+                            FROM cards) checked) ranked
+               WHERE c.id = ranked.id AND ranked.position > 1 AND ranked.is_empty""",
+            # Одна карта на пользователя. Если у пользователя несколько карт с данными, индекс не создается,
+            # пока их не объединят вручную: миграция повторяется при каждом подключении,
+            # а get_or_create_card работает и без индекса
+            "CREATE UNIQUE INDEX IF NOT EXISTS cards_user_id_key ON cards (user_id)"
+        ]),
+        (8, 'drop_unused_catalog_indexes', [
+            # Бот читает товары и остатки из catalog_stock, по этим индексам больше нет запросов,
+            # а каждый upsert товаров и остатков синхронизацией их обновлял
+            "DROP INDEX IF EXISTS products_group_uid_idx",
+            "DROP INDEX IF EXISTS product_remains_in_stock_idx"
+        ])
+    ]
+    # Миграции очистки дублей: их ошибка не останавливает следующие миграции и запуск,
+    # остальная схема от них не зависит. Непримененная миграция повторяется при каждом подключении
+    non_blocking_migrations = {3, 7}
+    # Горячие запросы для проверки планов: (название, таблицы, которые нельзя читать целиком,
+    # функция db -> (запрос, параметры)). Текст запросов берется из PGMgr - проверяется тот SQL, что выполняется
+    hot_queries = [
+        ('get_user', ('users',), lambda db: (db.get_user_query, (0,))),
+        ('get_card', ('cards',), lambda db: (db.get_card_query, (0,))),
+        ('get_user_with_card', ('users', 'cards'), lambda db: (db.get_user_with_card_query(), (0,))),
+        ('get_catalog_remains', ('catalog_stock',),
+         lambda db: (db.get_catalog_remains_query(True), ((EXPLAIN_UID,),))),
+        ('get_catalog_changes', ('product_groups', 'products', 'product_remains'),
+         lambda db: (db.get_catalog_changes_query, (EXPLAIN_TIME,) * 7)),
+        ('get_bonus_history', ('bonus_operations',), lambda db: (db.get_bonus_history_query(False), (0, 11))),
+        ('get_bonus_history_page', ('bonus_operations',),
+         lambda db: (db.get_bonus_history_query(True), (0, EXPLAIN_UID, 11)))
+    ]
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = Logger()
+
+    async def migrate(self) -> bool:
+        # Применяет недостающие миграции по порядку, на первой ошибке блокирующей миграции останавливается.
+        # Возвращает True, если применены все блокирующие миграции
+        create_migrations_table_query = """CREATE TABLE IF NOT EXISTS schema_migrations (
+                                               version integer PRIMARY KEY,
+                                               name text NOT NULL,
+                                               applied_at timestamptz NOT NULL DEFAULT now()
+                                           )"""
+        if await self.db.execute_command(create_migrations_table_query) is None:
+            return False
+
+        for version, name, queries in self.migrations:
+            async with self.db.transaction() as transaction:
+                # Построение индексов на больших таблицах может идти дольше statement_timeout и таймаута пула,
+                # запросы миграций ограничивает только maintenance_timeout
+                await self.db.execute_command("SET LOCAL statement_timeout = 0")
+                await self.db.execute_query("SELECT pg_advisory_xact_lock(%s)", self.migrations_lock_key)
+                applied = await self.db.execute_query("SELECT 1 FROM schema_migrations WHERE version = %s", version)
+                if not applied and not transaction['failed']:
+                    for query in queries:
+                        if await self.db.execute_command(query, timeout=self.db.maintenance_timeout) is None:
+                            break
+                    else:
+                        await self.db.execute_command("INSERT INTO schema_migrations (version, name) "
+                                                      "VALUES (%s, %s)", version, name)
+                        await self.logger.log(f"Применена миграция {version} {name}", level=LogLevel.INFO)
+
+            if not transaction['committed']:
+                await self.logger.log(f"Ошибка применения миграции {version} {name}", level=LogLevel.ERROR)
+                if version not in self.non_blocking_migrations:
+                    return False
+        return True
+
+    async def check_query_plans(self) -> list | None:
+        # Возвращает названия горячих запросов, которые читают таблицу целиком.
+        # Последовательное чтение запрещается, чтобы на маленькой таблице планировщик
+        # не выбрал его вместо индекса: если Seq Scan остался, подходящего индекса нет
+        seq_scans = []
+        checked = 0
+        try:
+            # SET LOCAL действует только до конца транзакции
+            async with self.db.transaction():
+                await self.db.execute_command("SET LOCAL enable_seqscan = off")
+                for name, tables, build_query in self.hot_queries:
+                    query, params = build_query(self.db)
+                    result = await self.db.execute_query(f"EXPLAIN (FORMAT JSON) {query}", *params)
+                    if not result:
+                        break
+                    checked += 1
+                    full_scans = set(tables) & self.get_seq_scans(result[0][0]['Plan'])
+                    if full_scans:
+                        seq_scans.append(name)
+                        await self.logger.log(f"Запрос {name} читает целиком: {', '.join(sorted(full_scans))}",
+                                              LogLevel.WARNING)
+            return seq_scans if checked == len(self.hot_queries) else None
+        except (Exception, psycopg2.Error) as error:
+            await self.logger.log(f"Ошибка проверки планов запросов - {error}", level=LogLevel.ERROR)
+            return None
+
+    def get_seq_scans(self, plan: dict) -> set:
+        tables = {plan['Relation Name']} if plan.get('Node Type') == 'Seq Scan' else set()
+        for sub_plan in plan.get('Plans', []):
+            tables |= self.get_seq_scans(sub_plan)
+        return tables
+
+
+# Проверка индексов: python -m Classes.SchemaMgr, код выхода 1 при полном чтении таблиц в горячих запросах
+async def main():
+    from Classes.PGMgr import PGMgr
+
+    db = PGMgr()
+    if not await db.connect_to_db():
+        return 2
+    try:
+        seq_scans = await SchemaMgr(db).check_query_plans()
+    finally:
+        await db.close_db_connection()
+
+    if seq_scans is None:
+        print('Не удалось проверить планы запросов')
+        return 2
+    for name in seq_scans:
+        print(f'Seq Scan: {name}')
+    print('Все горячие запросы используют индексы' if not seq_scans else f'Без индекса: {len(seq_scans)}')
+    return 1 if seq_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
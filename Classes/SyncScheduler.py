@@ -0,0 +1,111 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable
+from Classes.Logger import Logger, LogLevel
+
+
+# Этап синхронизации: корутина без аргументов, возвращающая True при успехе
+@dataclass(slots=True)
+class SyncStage:
+    name: str
+    run: Callable[[], Awaitable[bool]]
+    # Интервал между запусками в секундах, отсчитывается от начала предыдущего запуска
+    interval: float
+    # Этапы, которые должны отработать раньше, если им тоже пора запускаться
+    depends_on: tuple = ()
+    # Этапы с одинаковой группой не выполняются одновременно, даже если не зависят друг от друга
+    exclusive_group: str | None = None
+    # time.monotonic(), когда этапу пора запускаться
+    next_run_at: float = 0.0
+    runs: int = 0
+    failures: int = 0
+    # Длительность последнего запуска в секундах
+    last_duration: float | None = None
+    last_success_at: datetime | None = None
+
+
+# Планировщик синхронизации МойСклад. Каждый этап запускается по своему интервалу,
+# независимые этапы выполняются параллельно. Этап ждет свои зависимости, пока они выполняются
+# или ждут запуска, поэтому, например, остатки пишутся после свежих товаров и магазинов.
+# Зависимость не сдерживает сам зависимый этап, когда тот уже выполняется, - для этого есть группы исключения
+class SyncScheduler:
+    def __init__(self):
+        self.logger = Logger()
+        self.stages: dict[str, SyncStage] = {}
+        self.running: dict[str, asyncio.Task] = {}
+
+    def add_stage(self, name: str, run: Callable[[], Awaitable[bool]], interval: float,
+                  depends_on: tuple = (), exclusive_group: str | None = None) -> None:
+        # Зависимости добавляются раньше этапа, поэтому циклов между этапами быть не может
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f'Этап {name} зависит от неизвестного этапа {dependency}')
+        self.stages[name] = SyncStage(name, run, interval, tuple(depends_on), exclusive_group)
+
+    def is_due(self, stage: SyncStage, now: float) -> bool:
+        return stage.name not in self.running and stage.next_run_at <= now
+
+    def can_start(self, stage: SyncStage, now: float) -> bool:
+        if stage.exclusive_group and any(self.stages[name].exclusive_group == stage.exclusive_group
+                                         for name in self.running):
+            return False
+        return all(dependency not in self.running and not self.is_due(self.stages[dependency], now)
+                   for dependency in stage.depends_on)
+
+    async def run_stage(self, stage: SyncStage) -> None:
+        started_at = time.monotonic()
+        stage.runs += 1
+        try:
+            success = bool(await stage.run())
+        except Exception as error:
+            success = False
+            await self.logger.log(f"Ошибка этапа синхронизации {stage.name} - {error}", LogLevel.ERROR)
+        finally:
+            stage.last_duration = time.monotonic() - started_at
+            stage.next_run_at = started_at + stage.interval
+            self.running.pop(stage.name, None)
+
+        if success:
+            stage.last_success_at = datetime.now()
+        else:
+            stage.failures += 1
+        await self.logger.log(f"Этап {stage.name} {'выполнен' if success else 'завершился с ошибкой'} "
+                              f"за {stage.last_duration:.1f} с", LogLevel.INFO if success else LogLevel.WARNING)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                now = time.monotonic()
+                for stage in self.stages.values():
+                    if self.is_due(stage, now) and self.can_start(stage, now):
+                        self.running[stage.name] = asyncio.create_task(self.run_stage(stage))
+
+                # Этапы, ждущие зависимостей, проверяются заново, когда завершится один из запущенных
+                waiting = [stage.next_run_at - now for stage in self.stages.values()
+                           if stage.name not in self.running and stage.next_run_at > now]
+                timeout = min(waiting) if waiting else None
+                if self.running:
+                    await asyncio.wait(list(self.running.values()), timeout=timeout,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(timeout if timeout is not None else 1)
+        finally:
+            tasks = list(self.running.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def describe(self) -> str:
+        lines = ['Этапы синхронизации:']
+        for stage in self.stages.values():
+            duration = f'{stage.last_duration:.1f} с' if stage.last_duration is not None else '-'
+            last_success = f'{stage.last_success_at:%Y-%m-%d %H:%M:%S}' if stage.last_success_at else 'не было'
+            lines.append(f'{stage.name}: запусков {stage.runs}, ошибок {stage.failures}, '
+                         f'последний {duration}, успешно {last_success}'
+                         f"{' (выполняется)' if stage.name in self.running else ''}")
+        return '\n'.join(lines)
+
+    async def log_status(self) -> None:
+        await self.logger.log(self.describe(), level=LogLevel.INFO)
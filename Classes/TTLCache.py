@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+
+# Ограниченный по размеру кэш со сроком жизни записей.
+# При переполнении вытесняется запись, к которой дольше всего не обращались
+class TTLCache:
+    # Значение get() для отсутствующего или просроченного ключа
+    MISSING = object()
+
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name = name
+        self.max_size = max_size
+        # Срок жизни записи в секундах
+        self.ttl = ttl
+        # ключ -> (момент истечения, значение)
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key) -> bool:
+        # Проверка без учета в счетчиках попаданий
+        item = self.items.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return self.MISSING
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value) -> None:
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def discard(self, key) -> None:
+        self.items.pop(key, None)
+
+    def clear(self) -> None:
+        self.items.clear()
+
+    def describe(self) -> str:
+        requests = self.hits + self.misses
+        hit_ratio = self.hits / requests * 100 if requests else 0.0
+        return (f'Кэш {self.name}: записей {len(self.items)}/{self.max_size}, попаданий {self.hits}, '
+                f'промахов {self.misses} ({hit_ratio:.1f}% попаданий)')
@@ -66,3 +66,8 @@ async def get_error_phrase() -> str:
     phrase = (f'❗️Произошла ошибка❗️\n'
               f'Повторите позже или обратитесь в поддержку - 👤{SUPPORT_ID}')
     return phrase
+
+
+async def get_overload_phrase() -> str:
+    phrase = '⏳ Сейчас бот перегружен запросами. Пожалуйста, повторите через минуту.'
+    return phrase
@@ -0,0 +1,100 @@
+import asyncio
+import gc
+import random
+import tempfile
+import time
+import tracemalloc
+from Classes.CatalogMgr import CatalogMgr
+from benchmarks.synthetic_catalog import FakePGMgr, SyntheticCatalog
+
+# Бенчмарк горячих путей каталога: полная и частичная сборка снимка, память снимка
+# и задержка обработки нажатия. Время имитации запросов в FakePGMgr из времени сборки вычитается.
+# Запуск из корня проекта: python -m benchmarks.catalog_bench
+
+SIZES = [(1_000, 2, 6), (10_000, 3, 8), (100_000, 3, 12)]
+CLICKS = 2_000
+CHURN = 200
+
+
+async def bench_size(products_count: int, depth: int, fanout: int) -> dict:
+    catalog = SyntheticCatalog(products_count, depth, fanout)
+    db = FakePGMgr(catalog)
+    catalog_mgr = CatalogMgr(db)
+    catalog_mgr.cache_folder = tempfile.mkdtemp(prefix='catalog_bench_')
+
+    started = time.perf_counter()
+    await catalog_mgr.refresh(full=True)
+    build_time = time.perf_counter() - started - db.queries_time
+    build_queries = db.queries_count
+
+    # Память снимка меряется отдельной сборкой: tracemalloc сильно замедляет выполнение.
+    # Прежний снимок удерживается, чтобы его освобождение не вычиталось из результата
+    previous_snapshot = catalog_mgr.snapshot
+    gc.collect()
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    await catalog_mgr.refresh(full=True)
+    gc.collect()
+    snapshot_memory = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+    del previous_snapshot
+
+    # Частичная пересборка после изменения остатков
+    catalog.churn(CHURN)
+    db.reset_stats()
+    started = time.perf_counter()
+    await catalog_mgr.refresh()
+    delta_time = time.perf_counter() - started - db.queries_time
+    delta_queries = db.queries_count
+
+    snapshot = catalog_mgr.snapshot
+    rnd = random.Random(1)
+    uids = list(snapshot.groups_index)
+    clicks = [rnd.choice(uids) for _ in range(CLICKS)]
+    started = time.perf_counter()
+    for uid in clicks:
+        catalog_mgr.get_page(snapshot, uid)
+    click_time = (time.perf_counter() - started) / CLICKS
+
+    # Первое открытие дальних страниц больших групп рендерит их лениво
+    far_pages = [CatalogMgr.page_query(uid, page) for uid, starts in snapshot.page_starts.items()
+                 for page in range(1, len(starts))][:CLICKS]
+    started = time.perf_counter()
+    for query in far_pages:
+        catalog_mgr.get_page(snapshot, query)
+    far_page_time = (time.perf_counter() - started) / len(far_pages) if far_pages else 0.0
+
+    # Стоимость рендера страницы на каждое нажатие, как было до предварительного рендера
+    started = time.perf_counter()
+    for uid in clicks[:200]:
+        group = snapshot.groups_index[uid]
+        CatalogMgr.render_page(group.sub_groups, group, snapshot.products,
+                               snapshot.page_starts.get(uid, (0,)))
+    render_time = (time.perf_counter() - started) / 200
+
+    return {
+        'products': products_count,
+        'groups': len(catalog.groups),
+        'build_ms': build_time * 1000,
+        'build_queries': build_queries,
+        'delta_ms': delta_time * 1000,
+        'delta_queries': delta_queries,
+        'snapshot_mb': snapshot_memory / 2 ** 20,
+        'click_us': click_time * 1e6,
+        'far_page_us': far_page_time * 1e6,
+        'render_us': render_time * 1e6
+    }
+
+
+async def main():
+    columns = ['products', 'groups', 'build_ms', 'build_queries', 'delta_ms', 'delta_queries', 'snapshot_mb',
+               'click_us', 'far_page_us', 'render_us']
+    print(' | '.join(f'{column:>13}' for column in columns))
+    for products_count, depth, fanout in SIZES:
+        result = await bench_size(products_count, depth, fanout)
+        print(' | '.join(f'{result[column]:>13.2f}' if isinstance(result[column], float)
+                         else f'{result[column]:>13}' for column in columns))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+import asyncio
+import gc
+import tracemalloc
+from Classes.CatalogMgr import CatalogMgr
+from benchmarks.synthetic_catalog import FakePGMgr, SyntheticCatalog
+
+# Сравнение памяти, занимаемой деревом каталога: прежние вложенные словари
+# против компактной модели со __slots__ и массивами остатков.
+# Запуск из корня проекта: python -m benchmarks.catalog_memory
+
+
+def build_dict_tree(groups: list, remains: list) -> dict:
+    # Прежнее представление product_cash на вложенных словарях
+    nodes = {}
+    for uid, parent_uid, name, level in groups:
+        nodes[uid] = {'level': level, 'parent_uid': 'assortment' if level == 1 else parent_uid,
+                      'group_name': name, 'products': {}, 'subGroups': {}}
+
+    for group_uid, product_uid, product_name, store_name, count in remains:
+        nodes[group_uid]['products'].setdefault(product_name, {})[store_name] = int(count)
+
+    result = {}
+    for uid, parent_uid, name, level in groups:
+        node = nodes[uid]
+        if not node['products'] and not node['subGroups']:
+            continue
+        node['subGroups'] = dict(sorted(node['subGroups'].items(), key=lambda item: item[1]['group_name']))
+        (result if level == 1 else nodes[parent_uid]['subGroups'])[uid] = node
+    return dict(sorted(result.items(), key=lambda item: item[1]['group_name']))
+
+
+def measure(build, groups: list, remains: list) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = build(groups, remains)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del tree
+    return size
+
+
+async def main():
+    print(f'{"SKU":>8} | {"dict-дерево, МБ":>16} | {"slots-модель, МБ":>17} | {"экономия":>8}')
+    for products_count in (10_000, 100_000):
+        db = FakePGMgr(SyntheticCatalog(products_count, depth=3, fanout=12))
+        groups = await db.get_groups_tree()
+        remains = await db.get_catalog_remains()
+        dict_size = measure(build_dict_tree, groups, remains)
+        slots_size = measure(CatalogMgr.build_tree, groups, remains)
+        print(f'{products_count:>8} | {dict_size / 2 ** 20:>16.2f} | {slots_size / 2 ** 20:>17.2f} | '
+              f'{1 - slots_size / dict_size:>8.0%}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+# Генератор синтетического каталога и PGMgr в памяти для бенчмарков.
+# Отдает те же строки, что и запросы PGMgr, которыми пользуется CatalogMgr
+
+STORES = [('store-1', 'Братьев Кашириных 110'), ('store-2', 'Блюхера 85'), ('store-3', '250-летия Челябинска 67')]
+
+
+class SyntheticCatalog:
+    def __init__(self, products_count: int, depth: int = 3, fanout: int = 8, stock_density: float = 0.7,
+                 seed: int = 42):
+        self.random = random.Random(seed)
+        # Исходные строки записаны задолго до первой сборки, как в реальной БД
+        self.now = datetime(2024, 1, 1)
+        self.stock_density = stock_density
+        # uid -> (parent_uid, name, level, updated_at)
+        self.groups = {}
+        # uid -> (group_uid, name, prev_group_uid, updated_at)
+        self.products = {}
+        # (product_uid, store_uid) -> (count, updated_at)
+        self.remains = {}
+
+        self.add_groups(None, 1, depth, fanout)
+        group_uids = list(self.groups)
+        for i in range(products_count):
+            uid = f'product-{i}'
+            self.products[uid] = (self.random.choice(group_uids), f'Товар {i:06d} ({self.random.randint(1, 9)} шт.)',
+                                  None, self.now)
+            for store_uid, _ in STORES:
+                if self.random.random() < stock_density:
+                    self.remains[(uid, store_uid)] = (self.random.randint(1, 50), self.now)
+        self.now += timedelta(days=1)
+
+    def add_groups(self, parent_uid: str | None, level: int, depth: int, fanout: int) -> None:
+        if level > depth:
+            return
+        for _ in range(fanout):
+            uid = f'group-{len(self.groups)}'
+            self.groups[uid] = (parent_uid, f'Группа {len(self.groups):05d}', level, self.now)
+            self.add_groups(uid, level + 1, depth, fanout)
+
+    def churn(self, changes: int) -> None:
+        # Изменение остатков случайных товаров, как после одного цикла синхронизации
+        self.now += timedelta(minutes=30)
+        product_uids = list(self.products)
+        for _ in range(changes):
+            product_uid = self.random.choice(product_uids)
+            store_uid, _ = self.random.choice(STORES)
+            self.remains[(product_uid, store_uid)] = (self.random.randint(0, 50), self.now)
+
+
+class FakePGMgr:
+    catalog_channel = 'catalog_changed'
+
+    def __init__(self, catalog: SyntheticCatalog):
+        self.catalog = catalog
+        # Число запросов и время, потраченное на их имитацию, чтобы вычесть его из времени сборки
+        self.queries_count = 0
+        self.queries_time = 0.0
+
+    def reset_stats(self) -> None:
+        self.queries_count = 0
+        self.queries_time = 0.0
+
+    def has_replica(self) -> bool:
+        return False
+
+    async def get_catalog_watermark(self):
+        # Синтетический catalog_stock всегда актуален
+        self.queries_count += 1
+        return self.catalog.now
+
+    async def get_groups_tree(self, except_groups=None) -> list:
+        self.queries_count += 1
+        started = time.perf_counter()
+        rows = [(uid, parent_uid, name, level) for uid, (parent_uid, name, level, _) in self.catalog.groups.items()
+                if name not in (except_groups or [])]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        self.queries_time += time.perf_counter() - started
+        return rows
+
+    async def get_catalog_remains(self, group_uids: list | None = None) -> list:
+        self.queries_count += 1
+        started = time.perf_counter()
+        group_uids = set(group_uids) if group_uids else None
+        stores = dict(STORES)
+        rows = []
+        for (product_uid, store_uid), (count, _) in self.catalog.remains.items():
+            group_uid, name, _, _ = self.catalog.products[product_uid]
+            if count > 0 and (group_uids is None or group_uid in group_uids):
+                rows.append((group_uid, product_uid, name, stores[store_uid], count))
+        rows.sort(key=lambda row: (row[2], row[3]))
+        self.queries_time += time.perf_counter() - started
+        return rows
+
+    async def get_catalog_changes(self, since, until=None) -> list:
+        self.queries_count += 1
+        started = time.perf_counter()
+        changes = [('group', uid, parent_uid, None, updated_at)
+                   for uid, (parent_uid, _, _, updated_at) in self.catalog.groups.items() if updated_at > since]
+        changes += [('product', uid, group_uid, prev_group_uid, updated_at)
+                    for uid, (group_uid, _, prev_group_uid, updated_at) in self.catalog.products.items()
+                    if updated_at > since]
+        changes += [('remains', f'{product_uid}/{store_uid}', self.catalog.products[product_uid][0], None, updated_at)
+                    for (product_uid, store_uid), (_, updated_at) in self.catalog.remains.items()
+                    if updated_at > since]
+        self.queries_time += time.perf_counter() - started
+        return changes
@@ -24,6 +24,33 @@ def get_go_to_main_keyboard():
     return keyboard
 
 
+# Клавиатура под бонусной картой
+def get_bonus_card_keyboard():
+    # Добавляем кнопки
+    btn1 = InlineKeyboardButton(text='🧾История бонусов', callback_data='bonus_history')
+    btn2 = InlineKeyboardButton(text='⬅️Вернуться на главную', callback_data='go_to_main')
+
+    # Создаем inline клавиатуру
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[btn1], [btn2]])
+    return keyboard
+
+
+# Клавиатура страницы истории бонусов
+def get_bonus_history_keyboard(next_operation_id=None, is_first_page: bool = True):
+    pages_row = []
+    if not is_first_page:
+        pages_row.append(InlineKeyboardButton(text='⏮В начало', callback_data='bonus_history'))
+    if next_operation_id:
+        # Следующая страница начинается после последней показанной операции
+        pages_row.append(InlineKeyboardButton(text='Далее➡️', callback_data=f'bh_{next_operation_id}'))
+
+    keyboard_arr = [pages_row] if pages_row else []
+    keyboard_arr.append([InlineKeyboardButton(text='💳Вернуться к карте', callback_data='bonus_card')])
+    keyboard_arr.append([InlineKeyboardButton(text='⬅️Вернуться на главную', callback_data='go_to_main')])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_arr)
+    return keyboard
+
+
 # Клавиатура подписки на канал
 def get_subscribe_keyboard():
     # Добавляем кнопки
@@ -37,7 +64,7 @@ def get_subscribe_keyboard():
 
 
 # Клавиатура подписки на канал
-def get_dynamic_group_product_keyboard(groups: list, parent_group=None):
+def get_dynamic_group_product_keyboard(groups: list, parent_group=None, pages_row: list | None = None):
     grouped_buttons = zip_longest(*[iter(groups)] * 2, fillvalue=None)
     keyboard_arr = [
         [InlineKeyboardButton(text=value.get('group_name', 'NoName'), callback_data=value.get('group_uid', 'NoUid'))
@@ -45,6 +72,11 @@ def get_dynamic_group_product_keyboard(groups: list, parent_group=None):
         for row in grouped_buttons
     ]
 
+    # Кнопки листания страниц списка товаров
+    if pages_row:
+        keyboard_arr.append([InlineKeyboardButton(text=value['text'], callback_data=value['callback_data'])
+                             for value in pages_row])
+
     if parent_group is not None:
         keyboard_arr.append([InlineKeyboardButton(text='⬅️Назад', callback_data=str(parent_group))])
     keyboard_arr.append([InlineKeyboardButton(text='⬅️Вернуться на главную', callback_data='go_to_main')])
@@ -1,7 +1,9 @@
 from aiogram.enums import ChatMemberStatus, ParseMode
+import config
 from config import *
 from Classes.CardMgr import CardMgr
-from Classes.PGMgr import PGMgr
+from Classes.CatalogMgr import CatalogMgr
+from Classes.PGMgr import PGMgr, PoolSaturated
 from Classes.MoySkladAPI import MoyskladAPI
 from Classes.Logger import Logger, LogLevel
 from keyboards import *
@@ -34,9 +36,31 @@ db = PGMgr()
 # Класс для логирования
 logger = Logger()
 
-# Переменная которая хранит кэш продуктов
-product_cash = {}
+# Класс сборки каталога товаров
+catalog_mgr = CatalogMgr(db)
 
+# Количество операций на странице истории бонусов
+BONUS_HISTORY_PAGE_SIZE = 10
+
+
+async def shed_overload(handler, event, data):
+    # При перегрузке пула запросы обработчика не встают в очередь за соединением,
+    # пользователь сразу получает ответ о перегрузке
+    token = db.shedding.set(True)
+    try:
+        return await handler(event, data)
+    except PoolSaturated as error:
+        await logger.log(f'Запрос отброшен из-за перегрузки БД: {error}', level=LogLevel.WARNING)
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(text=await get_overload_phrase(), show_alert=True)
+        elif isinstance(event, types.Message):
+            await event.answer(await get_overload_phrase())
+    finally:
+        db.shedding.reset(token)
+
+
+dp.message.outer_middleware(shed_overload)
+dp.callback_query.outer_middleware(shed_overload)
 
 # Хэндлер на команду /start
 @dp.message(Command("start"))
@@ -54,7 +78,8 @@ async def message_handler(message: types.Message):
 async def handle_callback_query(callback_query: types.CallbackQuery):
     query = callback_query.data
     tg_id = callback_query.from_user.id
-    user = await db.get_user(tg_id)
+    # Пользователь и карта одним запросом, при повторных нажатиях - из кэша
+    user, card = await db.get_user_with_card(tg_id)
 
     if not user or len(user) < 1:
         user = await registration_user(callback_query.from_user)
@@ -66,9 +91,13 @@ async def handle_callback_query(callback_query: types.CallbackQuery):
             return
 
     if query == 'bonus_card':
-        await show_bonus_card(user, callback_query)
+        await show_bonus_card(user, callback_query, card)
+    elif query == 'bonus_history' or query.startswith('bh_'):
+        # bh_<operation_id> - страница, начинающаяся после этой операции
+        after_operation_id = query[3:] if query.startswith('bh_') else None
+        await show_bonus_history(user, callback_query, card, after_operation_id)
     elif query == 'assortment':
-        await show_groups(callback_query, product_cash)
+        await show_groups(callback_query, query)
     elif query == 'addresses' or query == 'go_back_to_addresses':
         await show_addresses_shop(callback_query)
     elif query.startswith('location_'):
@@ -91,13 +120,9 @@ async def handle_callback_query(callback_query: types.CallbackQuery):
             await bot.answer_callback_query(callback_query.id, text="Вы не найдены среди подписчиков канала. 📢")
         else:
             await bot.answer_callback_query(callback_query.id, text="Готовлю вашу карту 💳...")
-            await show_bonus_card(user, callback_query)
+            await show_bonus_card(user, callback_query, card)
     else:
-        group_data = await find_values_by_key_async(product_cash, query)
-
-        if group_data:
-            await show_groups(callback_query, group_data=group_data)
-        else:
+        if not await show_groups(callback_query, query):
             await bot.answer_callback_query(callback_query.id, text="Я не знаю такой команды🫥")
 
 
@@ -132,23 +157,13 @@ async def registration_user(user: User) -> tuple | None:
     last_name = user.last_name
     language_code = user.language_code
     is_bot = user.is_bot
-    role = await db.get_role('USER')
 
-    if not role or len(role) < 1:
-        await logger.log(f'Не найдена роль USER', level=LogLevel.ERROR)
-        return
-    role_id = role[0]
-
-    is_create = await db.create_user(tg_id, role_id, user_name, first_name, last_name, language_code, is_bot)
+    # Роль USER закэширована при подключении, повторная регистрация возвращает существующего пользователя
+    is_create = await db.upsert_user(tg_id, user_name, first_name, last_name, language_code, is_bot)
     return is_create
 
 
-async def create_bonus_card(user: tuple) -> tuple | None:
-    card = await db.create_card(user[0], 0, '')
-    return card
-
-
-async def show_bonus_card(user: tuple, callback_query: types.CallbackQuery) -> None:
+async def show_bonus_card(user: tuple, callback_query: types.CallbackQuery, card: tuple | None = None) -> None:
     subscription_to_chanel = await is_user_in_channel(callback_query.from_user.id, OWN_CHANEL_ID)
 
     if not subscription_to_chanel:
@@ -159,9 +174,8 @@ async def show_bonus_card(user: tuple, callback_query: types.CallbackQuery) -> N
                                     reply_markup=get_subscribe_keyboard())
         return
 
-    card = await db.get_card(user[0])
-    if not card or len(card) < 1:
-        card = await create_bonus_card(user)
+    if not card:
+        card = await db.get_or_create_card(user[0])
         if not card or len(card) < 1:
             await callback_query.answer(text=await get_error_phrase(), show_alert=True)
             await logger.log(f'Ошибка создания карты! tg_id - {callback_query.from_user.id}',
@@ -178,7 +192,7 @@ async def show_bonus_card(user: tuple, callback_query: types.CallbackQuery) -> N
         except Exception as error:
             await logger.log(error, LogLevel.ERROR)
         result = await bot.send_photo(chat_id=callback_query.message.chat.id, photo=card_file, caption=caption,
-                                      reply_markup=get_go_to_main_keyboard(), parse_mode=ParseMode.MARKDOWN_V2)
+                                      reply_markup=get_bonus_card_keyboard(), parse_mode=ParseMode.MARKDOWN_V2)
     else:
         await bot.edit_message_text(text="Создаю Вашу карту 💳 ...\nПожалуйста ожидайте.",
                                     chat_id=callback_query.message.chat.id,
@@ -200,66 +214,75 @@ async def show_bonus_card(user: tuple, callback_query: types.CallbackQuery) -> N
         except Exception as error:
             await logger.log(error, LogLevel.ERROR)
         result = await bot.send_photo(chat_id=callback_query.message.chat.id, photo=card_photo, caption=caption,
-                                      reply_markup=get_go_to_main_keyboard(), parse_mode=ParseMode.MARKDOWN_V2)
+                                      reply_markup=get_bonus_card_keyboard(), parse_mode=ParseMode.MARKDOWN_V2)
         card_file_id = result.photo[len(result.photo) - 1].file_id
         await db.set_card_file_id(user[0], card_file_id)
 
 
-async def show_groups(callback_query: types.CallbackQuery, group_data: dict | list) -> None:
-    data_keyboard = {}
-    parent_group = None
-    replacement_dict = {
-        '_': '\\_',
-        '*': '\\*',
-        '[': '\\[',
-        ']': '\\]',
-        '(': '\\(',
-        ')': '\\)',
-        '~': '\\~',
-        '`': '\\`',
-        '>': '\\>',
-        '#': '\\#',
-        '+': '\\+',
-        '-': '\\-',
-        '=': '\\=',
-        '|': '\\|',
-        '{': '\\{',
-        '}': '\\}',
-        '.': '\\.',
-        '!': '\\!'
-    }
-
-    translation_table = str.maketrans(replacement_dict)
-    text_msg = ('*Выберите интересующую группу товаров, используя кнопки, '
-                'размещенные ⬇️под сообщением⬇️*')
-
-    if group_data and isinstance(group_data, dict):
-        data_keyboard = [{'group_name': group_data[group]['group_name'], 'group_uid': group} for group in
-                         group_data.keys()]
-    elif group_data and isinstance(group_data, list):
-        # data_keyboard = group_data[0].get('subGroups', {})
-        sub_groups = group_data[0].get('subGroups', [])
-        parent_group = group_data[0]['parent_uid']
-
-        data_keyboard = [{'group_name': sub_groups.get(subgroup, {})['group_name'], 'group_uid': subgroup} for subgroup
-                         in sub_groups.keys()]
-        products = group_data[0].get('products', {})
-
-        if products:
-            text_msg = '\n'.join(
-                '*' + str(product).translate(translation_table) + ':*\n' +
-                '\n'.join(str('🏪' + key + ': ' + str(value)).translate(translation_table)
-                          for key, value in products.get(product, {}).items()) + '\n'
-                for product in products.keys()
-            )
+async def show_bonus_history(user: tuple, callback_query: types.CallbackQuery, card: tuple | None = None,
+                             after_operation_id: str | None = None) -> None:
+    if not card:
+        card = await db.get_card(user[0])
+    if not card:
+        await callback_query.answer(text="Бонусная карта еще не создана 💳", show_alert=True)
+        return
+
+    # Одна лишняя строка показывает, есть ли следующая страница
+    operations = await db.get_bonus_history(card[0], after_operation_id, BONUS_HISTORY_PAGE_SIZE + 1)
+    if operations is None:
+        await callback_query.answer(text=await get_error_phrase(), show_alert=True)
+        return
+
+    has_next_page = len(operations) > BONUS_HISTORY_PAGE_SIZE
+    operations = operations[:BONUS_HISTORY_PAGE_SIZE]
+    if operations:
+        lines = []
+        for _, moment_operation, points_earned in operations:
+            moment = moment_operation.strftime('%d.%m.%Y %H:%M') if hasattr(moment_operation, 'strftime') \
+                else str(moment_operation)[:16]
+            points = str(points_earned).replace('.', ',')
+            lines.append(f"{moment}  {'+' if points_earned > 0 else ''}{points} ₽")
+        text_msg = "🧾История бонусов:\n\n" + '\n'.join(lines)
+    elif after_operation_id:
+        text_msg = "Более ранних операций нет."
+    else:
+        text_msg = "По вашей карте пока нет операций с бонусами."
+
+    keyboard = get_bonus_history_keyboard(operations[-1][0] if has_next_page else None,
+                                          is_first_page=after_operation_id is None)
+    # Карта отправлена фотографией, у неё нельзя заменить подпись на текст - отправляем новое сообщение
+    if callback_query.message.photo:
+        try:
+            await callback_query.message.delete()
+        except Exception as error:
+            await logger.log(error, LogLevel.ERROR)
+        await callback_query.message.answer(text=text_msg, reply_markup=keyboard)
+    else:
+        await bot.edit_message_text(text=text_msg,
+                                    chat_id=callback_query.message.chat.id,
+                                    message_id=callback_query.message.message_id,
+                                    reply_markup=keyboard)
+
+
+async def show_groups(callback_query: types.CallbackQuery, query: str) -> bool:
+    # Снимок берется один раз, чтобы весь ответ был собран из одной версии каталога
+    snapshot = catalog_mgr.snapshot
+    page = catalog_mgr.get_page(snapshot, query)
+    if not page:
+        return False
+
+    text_msg, keyboard = page
+    # Версия и возраст снимка попадают в периодическую статистику, а не в лог на каждое нажатие
+    catalog_mgr.record_page_served(snapshot)
 
     await bot.edit_message_text(
         text=text_msg,
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
-        reply_markup=get_dynamic_group_product_keyboard(data_keyboard, parent_group),
+        reply_markup=keyboard,
         parse_mode=ParseMode.MARKDOWN_V2
     )
+    return True
 
 
 async def show_addresses_shop(callback_query: types.CallbackQuery) -> None:
@@ -288,74 +311,34 @@ async def send_info_shop(callback_query: types.CallbackQuery, latitude, longitud
         await bot.send_message(callback_query.from_user.id, 'График работы:\nПН-ВС 10:00-22:00', reply_markup=keyboard)
 
 
-async def create_groups_list(parent_uid: str | None, level=0) -> dict:
-    groups = await db.get_groups_by_parent(parent_uid, ['NoMark'])
-    if groups is None:
-        await logger.log('Нет данных о группах товаров!', logger.log_level.WARN)
-        return {}
-    level += 1
-
-    result = {
-        str(group[0]): {
-            'level': level,
-            'parent_uid': 'assortment' if level == 1 else parent_uid,
-            'group_name': group[1],
-            'products': {
-                product[1]: {
-                    store[0]: int(store[1])
-                    for store in await db.get_product_remains(product[0])
-                    if store and str(store[2]) in stores_list
-                }
-                for product in await db.get_products_by_group(group[0])
-                if product and any(store for store in await db.get_product_remains(product[0]))
-            },
-            'subGroups': await create_groups_list(group[0], level)
-        }
-        for group in groups
-        if await create_groups_list(group[0], level) or any([
-            product and any(store for store in await db.get_product_remains(product[0]))
-            for product in await db.get_products_by_group(group[0])
-        ])
-    }
-
-    # Сортировка словаря по 'group_name'
-    sorted_result = dict(
-        sorted(result.items(), key=lambda item: item[1]['group_name'])
-    )
-    return sorted_result
-
-
 async def is_user_in_channel(user_id: int, chanel_id: int | str) -> bool:
     chat_member = await bot.get_chat_member(chanel_id, user_id)
     return chat_member.status in [ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.MEMBER]
 
 
-async def find_values_by_key_async(dictionary, target_key):
-    result = []
-
-    for key, value in dictionary.items():
-        if key == target_key:
-            result.append(value)
-
-        if isinstance(value, dict):
-            # Используем асинхронный вариант цикла for
-            nested_values = await find_values_by_key_async(value, target_key)
-            result.extend(nested_values)
-
-    return result
-
-
 async def background_task():
     try:
         await logger.log('Запускаем фоновую задачу по обновлению кэша товаров...', level=LogLevel.INFO)
         while True:
-            await asyncio.sleep(300)  # Пример: ждем 300 секунд между итерациями
-            global product_cash
-            product_cash = await create_groups_list(None)
+            # Каталог обновляется по уведомлениям из БД, таймер только подстраховывает
+            await asyncio.sleep(catalog_mgr.fallback_refresh_interval)
+            await catalog_mgr.refresh()
     except asyncio.CancelledError:
         await logger.log('Background task is cancelled.', level=LogLevel.INFO)
 
 
+async def query_stats_task():
+    # Периодически пишет в лог статистику запросов к БД и свежесть каталога за прошедший период
+    interval = getattr(config, 'PG_STATS_INTERVAL', 3600)
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await db.log_query_stats(reset=True)
+            await catalog_mgr.log_freshness(reset=True)
+    except asyncio.CancelledError:
+        await logger.log('Query stats task is cancelled.', level=LogLevel.INFO)
+
+
 # Запуск процесса поллинга новых апдейтов
 async def main():
     tasks = []
@@ -369,18 +352,27 @@ async def main():
             await logger.log('НЕ УДАЛОСЬ ПОДКЛЮЧИТЬСЯ К БД!!!', logger.log_level.ERROR)
             return False
 
-        global product_cash
-        product_cash = await create_groups_list(None)
-        # await logger.log(product_cash)
+        tasks.append(asyncio.create_task(catalog_mgr.watch_changes()))
+        tasks.append(asyncio.create_task(query_stats_task()))
+
+        # С сохраненным снимком поллинг начинается сразу, а свежий каталог собирается в фоне
+        if await catalog_mgr.load_snapshot():
+            tasks.append(asyncio.create_task(catalog_mgr.refresh()))
+        else:
+            await catalog_mgr.refresh()
+
         await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot, polling_timeout=8)
     finally:
         # В блоке finally закрываем все необходимые ресурсы
         await logger.log('Завершаем работу бота.', level=LogLevel.INFO)
+        # Ожидаем завершения всех задач в списке, прослушивание уведомлений держит соединение из пула
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await db.log_query_stats()
+        await catalog_mgr.log_freshness()
         await db.close_db_connection()
-        # Ожидаем завершения всех задач в списке
-        bg_task.cancel()
-        await asyncio.gather(bg_task, return_exceptions=True)
 
 
 if __name__ == '__main__':
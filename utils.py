@@ -1,8 +1,22 @@
 import asyncio
 
+import config
 from Classes.Logger import Logger
 from Classes.Logger import LogLevel
 from Classes.MoySkladAPI import MoyskladAPI
+from Classes.SyncScheduler import SyncScheduler
+
+# Интервалы запуска этапов синхронизации в секундах, переопределяются через MS_SYNC_INTERVALS в config
+SYNC_INTERVALS = {
+    'counterparties': 300,
+    'stores': 3600,
+    'uoms': 3600,
+    'groups': 600,
+    'products': 600,
+    'stock': 120,
+    'bonus': 120,
+    'stats': 900
+}
 
 
 async def background_task():
@@ -10,29 +24,32 @@ async def background_task():
     try:
         await logger.log('Запускаем фоновую задачу...', level=LogLevel.INFO)
         async with MoyskladAPI() as api:
-            while True:
-                print('Получаем данные о клиентах')
-                await api.get_counterparties(tag="клиент")
-                await asyncio.sleep(60)
-                print('Получаем данные о магазинах')
-                await api.get_stores()
-                await asyncio.sleep(60)
-                print('Получаем данные о единицах измерения')
-                await api.get_uoms()
-                await asyncio.sleep(60)
-                print('Получаем данные о группах товаров')
-                await api.get_groups_product()
-                await asyncio.sleep(60)
-                print('Получаем данные о товарах')
-                await api.get_products()
-                await asyncio.sleep(60)
-                print('Получаем данные об остатках на складах')
-                await api.get_stock_by_stores()
-                await asyncio.sleep(60)
-                print('Получаем данные о бонусных операциях')
-                await api.get_bonus_operations()
-                print('Ожидаем следующего цикла')
-                await asyncio.sleep(300)  # Пример: ждем 300 секунд между итерациями
+            scheduler = SyncScheduler()
+            intervals = {**SYNC_INTERVALS, **getattr(config, 'MS_SYNC_INTERVALS', {})}
+
+            async def log_sync_stats() -> bool:
+                await api.db.log_query_stats(reset=True)
+                await api.client.log_stats(reset=True)
+                await scheduler.log_status()
+                return True
+
+            # Зависимости: товары ссылаются на группы и единицы измерения, остатки - на товары и магазины,
+            # бонусные операции сопоставляются с картами контрагентов.
+            # Магазины, товары и остатки пересобирают catalog_stock и по очереди: изменение, зафиксированное
+            # после пересборки другим этапом, бот счел бы уже учтенным и не увидел до полной пересборки каталога
+            scheduler.add_stage('counterparties', lambda: api.get_counterparties(tag="клиент"),
+                                intervals['counterparties'])
+            scheduler.add_stage('stores', api.get_stores, intervals['stores'], exclusive_group='catalog_stock')
+            scheduler.add_stage('uoms', api.get_uoms, intervals['uoms'])
+            scheduler.add_stage('groups', api.get_groups_product, intervals['groups'])
+            scheduler.add_stage('products', api.get_products, intervals['products'], depends_on=('groups', 'uoms'),
+                                exclusive_group='catalog_stock')
+            scheduler.add_stage('stock', api.get_stock_by_stores, intervals['stock'],
+                                depends_on=('products', 'stores'), exclusive_group='catalog_stock')
+            scheduler.add_stage('bonus', api.get_bonus_operations, intervals['bonus'],
+                                depends_on=('counterparties',))
+            scheduler.add_stage('stats', log_sync_stats, intervals['stats'])
+            await scheduler.run()
     except asyncio.CancelledError:
         await logger.log('Background task is cancelled.', level=LogLevel.INFO)
         print('Выполнение задач завершено! Смотреть лог ошибок...')
@@ -41,4 +58,4 @@ async def background_task():
         print('Завершаем работу утилит')
 
 if __name__ == '__main__':
-    asyncio.run(background_task())
\ No newline at end of file
+    asyncio.run(background_task())